@@ -0,0 +1,168 @@
+"""シミュレーションエンジンのベンチマーク: エージェント数/グリッド/エネルギー密度/ステップ数のスケール点ごとに計測
+
+ネットワーク無しの決定的なフェイクLLM（プロンプトのハッシュで行動を選ぶ）で Simulation.step を回し、
+steps/sec・ピークRSS・フェーズ別時間（StepProfiler）・visualize 1フレームの時間を出す。
+スケール点ごとに別プロセスで実行するので、ピークRSSは点ごとの値になる。
+
+    python bench/engine.py --preset quick
+    python bench/engine.py --agents 5,50,500,5000 --grid 30,100,500 --density 0.02 --steps 20 --json > bench.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import sys
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import main  # noqa: E402
+from stub_server import random_action  # noqa: E402
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+PRESETS = {
+    'quick': {'agents': [5, 50, 500], 'grid': [30, 100], 'density': [0.02], 'steps': [10]},
+    'full': {'agents': [5, 50, 500, 5000], 'grid': [30, 100, 500], 'density': [0.005, 0.02, 0.1], 'steps': [20]},
+}
+# 回帰を追う主要フェーズ（StepProfilerの名前）
+KEY_PHASES = ['step', 'agents', 'local_view', 'build_prompt', 'apply', 'publish', 'log', 'render']
+
+
+class FakeLLMClient:
+    """GrokClientの代わり。同じプロンプトには常に同じ行動を返す（並行実行の順序に依らず決定的）"""
+
+    def __init__(self, seed: int = 0):
+        self.seed = seed
+        self.calls = 0
+        self.scheduler = main.RequestScheduler(rpm=1e9, tpm=1e12, max_concurrency=1 << 20)
+        self.cache = None
+
+    async def chat(self, payload: dict) -> str:
+        self.calls += 1
+        user_prompt = payload['messages'][-1]['content']
+        rng = random.Random(zlib.crc32(user_prompt.encode('utf-8')) ^ self.seed)
+        action = random_action(rng, user_prompt)
+        return "Action: [{}]\nMessage: [bench]\nThought: [fake decided {}]".format(action, action)
+
+    async def close(self):
+        pass
+
+
+def peak_rss_mb() -> float:
+    if resource is None:
+        return float('nan')
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / 1024 if sys.platform == 'darwin' else rss / 1024  # macOSはバイト、Linuxはキロバイト
+
+
+async def run_point(point: dict) -> dict:
+    grid = point['grid']
+    sim = main.Simulation(num_agents=point['agents'], grid_size=grid, api_key='bench', seed=point['seed'],
+                          spawn_energy_count=max(1, int(point['density'] * grid * grid)),
+                          log_history=1, profiler=main.StepProfiler())
+    await sim.client.close()
+    sim.client = FakeLLMClient(point['seed'])
+    try:
+        started = time.perf_counter()
+        steps = 0
+        for _ in range(point['steps']):
+            await sim.step()
+            steps += 1
+            if not sim.agents:
+                break
+        elapsed = time.perf_counter() - started
+        for _ in range(point['frames']):
+            t0 = time.perf_counter()
+            sim.visualize('/dev/null' if sys.platform != 'win32' else 'NUL')
+            sim.profiler.record('render', time.perf_counter() - t0)
+    finally:
+        await sim.close()
+    report = sim.profiler.report()
+    return {
+        **point,
+        'steps_run': steps,
+        'final_alive': len(sim.agents),
+        'llm_calls': sim.client.calls,
+        'wall_s': elapsed,
+        'steps_per_sec': steps / elapsed if elapsed > 0 else 0.0,
+        'peak_rss_mb': peak_rss_mb(),
+        'phases': {name: {k: report['phases'][name][k] for k in ('total', 'mean', 'p50', 'p95', 'p99')}
+                   for name in KEY_PHASES if name in report['phases']},
+    }
+
+
+def run_point_sync(point: dict) -> dict:
+    import contextlib
+    import io
+    with contextlib.redirect_stdout(io.StringIO()):  # Simulationの初期化/保存ログを黙らせる
+        return asyncio.run(run_point(point))
+
+
+def scale_points(args) -> list:
+    grid_axes = PRESETS[args.preset] if args.preset else {}
+    axes = {name: getattr(args, name) or grid_axes.get(name) or PRESETS['quick'][name]
+            for name in ('agents', 'grid', 'density', 'steps')}
+    return [{'agents': a, 'grid': g, 'density': d, 'steps': s, 'frames': args.frames, 'seed': args.seed}
+            for a, g, d, s in itertools.product(axes['agents'], axes['grid'], axes['density'], axes['steps'])]
+
+
+def bench(args) -> list:
+    results = []
+    for point in scale_points(args):
+        if args.in_process:
+            result = run_point_sync(point)
+        else:
+            # 1点 = 1プロセス（ピークRSSを点ごとに分ける）
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as pool:
+                result = pool.submit(run_point_sync, point).result()
+        results.append(result)
+        if not args.json:
+            print(format_row(result), flush=True)
+    return results
+
+
+def format_row(r: dict) -> str:
+    def ms(name):
+        return r['phases'].get(name, {}).get('mean', 0.0) * 1e3
+
+    return ("agents {:>5} grid {:>4} dens {:>6.3f} steps {:>3}/{:<3} | {:>8.2f} steps/s  rss {:>7.1f} MB | "
+            "step {:>8.2f} ms  view {:>6.3f} ms  log {:>7.2f} ms  render {:>7.1f} ms").format(
+        r['agents'], r['grid'], r['density'], r['steps_run'], r['steps'], r['steps_per_sec'], r['peak_rss_mb'],
+        ms('step'), ms('local_view'), ms('log'), ms('render'))
+
+
+def int_list(text: str) -> list:
+    return [int(x) for x in text.split(',')]
+
+
+def float_list(text: str) -> list:
+    return [float(x) for x in text.split(',')]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--preset', choices=sorted(PRESETS), default=None, help='軸の既定値（個別指定が優先）')
+    parser.add_argument('--agents', type=int_list, default=None, help='例: 5,50,500,5000')
+    parser.add_argument('--grid', type=int_list, default=None, help='例: 30,100,500')
+    parser.add_argument('--density', type=float_list, default=None, help='初期エネルギー源の密度（源の数/セル数）')
+    parser.add_argument('--steps', type=int_list, default=None)
+    parser.add_argument('--frames', type=int, default=1, help='計測するvisualizeのフレーム数（0で省略）')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--in-process', action='store_true', help='別プロセスにしない（ピークRSSは累積になる）')
+    parser.add_argument('--json', action='store_true', help='結果をJSONで出力')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = bench(args)
+    if args.json:
+        print(json.dumps({'python': sys.version.split()[0], 'results': results}, indent=2))
@@ -0,0 +1,107 @@
+"""HTTP接続プールのベンチマーク: ステップごとの新規セッション vs 共有Keep-Aliveプール
+
+ローカルのOpenAI互換スタブ(/v1/chat/completions)に対して、1ステップ = 全エージェント同時リクエスト
+を繰り返し、1ステップあたりのレイテンシを比較する。
+
+    python bench/http_pool.py --agents 50 --steps 20 --latency-ms 20
+
+※ローカルはHTTPなのでTCPハンドシェイク分のみ。api.x.ai (TLS) ではさらにTLSハンドシェイク分が上乗せされる。
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+
+import aiohttp
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from main import GrokClient, RequestScheduler  # noqa: E402
+from stub_server import StubConfig, start_stub_server  # noqa: E402
+
+
+def make_payload(i: int) -> dict:
+    return {"model": "bench", "messages": [{"role": "user", "content": f"agent {i}"}], "max_tokens": 150}
+
+
+async def fresh_session_call(url: str, payload: dict) -> str:
+    """旧実装と同じ: 呼び出しごとにClientSessionを作って捨てる"""
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, json=payload, headers={"Authorization": "Bearer bench"}) as resp:
+            result = await resp.json()
+            return result['choices'][0]['message']['content']
+
+
+async def run_steps(call, num_agents: int, num_steps: int) -> list:
+    step_times = []
+    for _ in range(num_steps):
+        t0 = time.perf_counter()
+        await asyncio.gather(*[call(make_payload(i)) for i in range(num_agents)])
+        step_times.append(time.perf_counter() - t0)
+    return step_times
+
+
+def summarize(step_times: list) -> dict:
+    ordered = sorted(step_times)
+    return {
+        'mean_ms': 1000 * sum(ordered) / len(ordered),
+        'p50_ms': 1000 * ordered[len(ordered) // 2],
+        'max_ms': 1000 * ordered[-1]
+    }
+
+
+async def bench(args):
+    runner = None
+    url = args.url
+    if url is None:
+        runner, _ = await start_stub_server(StubConfig(latency_ms=args.latency_ms), port=args.port)
+        url = 'http://127.0.0.1:{}/v1/chat/completions'.format(args.port)
+    try:
+        fresh = await run_steps(lambda p: fresh_session_call(url, p), args.agents, args.steps)
+        # レート制限はベンチの邪魔なので実質無制限に
+        scheduler = RequestScheduler(rpm=1e9, tpm=1e12, max_concurrency=args.pool_limit)
+        client = GrokClient("bench", api_url=url, pool_limit=args.pool_limit, pool_limit_per_host=args.pool_limit,
+                            scheduler=scheduler)
+        try:
+            pooled = await run_steps(client.chat, args.agents, args.steps)
+        finally:
+            await client.close()
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+
+    result = {
+        'agents': args.agents,
+        'steps': args.steps,
+        'stub_latency_ms': args.latency_ms if args.url is None else None,
+        'fresh_session': summarize(fresh),
+        'pooled': summarize(pooled)
+    }
+    result['saved_per_step_ms'] = result['fresh_session']['mean_ms'] - result['pooled']['mean_ms']
+    return result
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--agents', type=int, default=50)
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--latency-ms', type=float, default=20.0, help='内蔵スタブの応答遅延')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--pool-limit', type=int, default=100)
+    parser.add_argument('--url', default=None, help='外部スタブのURL（指定時は内蔵スタブを起動しない）')
+    parser.add_argument('--json', action='store_true', help='結果をJSONで出力')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    result = asyncio.run(bench(args))
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print("Agents: {}  Steps: {}".format(result['agents'], result['steps']))
+        for key in ('fresh_session', 'pooled'):
+            r = result[key]
+            print("  {:<14} mean {:8.2f} ms  p50 {:8.2f} ms  max {:8.2f} ms".format(key, r['mean_ms'], r['p50_ms'], r['max_ms']))
+        print("  Saved per step: {:.2f} ms".format(result['saved_per_step_ms']))
@@ -7,10 +7,15 @@ import multiprocessing as mp  # 並列実行用
 import matplotlib
 matplotlib.use('Agg')  # ヘッドレス実行用（サーバー/Tkinter不要）
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.lines import Line2D
 
 # 非同期HTTP (Grok APIコール用)
 import asyncio
 import aiohttp
+import queue
+import threading
 
 # 文字列処理
 import re
@@ -18,17 +23,51 @@ import re
 # ファイル/JSON出力
 import json
 import os
+import time
+import math
+import heapq
+import hashlib
+import sqlite3
+import gzip
+import io
+import zlib
+import shutil
+import subprocess
+from email.utils import parsedate_to_datetime
 from pathlib import Path
+from collections import deque
+from collections.abc import MutableMapping
 
 # Streamlit UI用
 import streamlit as st
 
+# 任意依存（ログのzstd圧縮用、無ければgzip/無圧縮のみ）
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 任意依存（イベント表のParquet/Arrow IPC出力用、無ければNPZ）
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# 任意依存（動画出力のGIF/APNGフォールバック用、matplotlibの依存なので通常は入っている）
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
 # 型ヒント
-from typing import List, Tuple, Dict, Optional
+import abc
+from typing import List, Tuple, Dict, Optional, NamedTuple
 
 NUM_CLUSTERS = 3
 CLUSTER_RADIUS = 5
 VIEW_RANGE = 5
+MESSAGE_INBOX_LIMIT = 10  # 1エージェントが1ターンに受け取るメッセージ数の上限（古い順に捨てる）
 # 新しい定数（paramsでオーバーライド可能）
 INITIAL_ENERGY = 150
 SPAWN_ENERGY_COUNT = 20
@@ -37,6 +76,41 @@ CHILD_INITIAL_ENERGY = 150  # 子エージェントの初期エネルギー
 ENERGY_SPAWN_RATE = 0.001  # ステップごとのランダム生成率（未使用だったのを有効化）
 CUSTOM_WORLD_PROMPT = ""  # デフォルト空、世界観カスタム
 
+# Grok API接続設定（コネクションプール共有でTCP/TLSハンドシェイクを毎回払わない）
+API_URL = "https://api.x.ai/v1/chat/completions"
+HTTP_POOL_LIMIT = 100  # プール全体の同時接続上限
+HTTP_POOL_LIMIT_PER_HOST = 50  # ホストごとの同時接続上限
+HTTP_DNS_CACHE_TTL = 300  # DNSキャッシュ保持秒数
+HTTP_KEEPALIVE_TIMEOUT = 60  # アイドル接続を保持する秒数
+HTTP_TIMEOUT = 120  # 1リクエストの合計タイムアウト秒数
+# レート制限（アカウント上限に合わせてparamsで調整）
+RATE_LIMIT_RPM = 480  # 1分あたりリクエスト数
+RATE_LIMIT_TPM = 2000000  # 1分あたりトークン数
+MAX_CONCURRENT_REQUESTS = 32  # 同時実行中リクエストの上限
+MAX_RETRIES = 6  # 429/5xx/通信エラー時のリトライ回数
+RETRY_BASE_DELAY = 0.5  # 指数バックオフの初期待ち秒数
+RETRY_MAX_DELAY = 30.0  # バックオフ待ちの上限秒数
+# 遅い/落ちているエンドポイント対策（期限切れ・ヘッジ要求・サーキットブレーカー）
+HEDGE_MIN_SAMPLES = 20  # ヘッジ要求: 分位点を信用するまでに必要な成功数
+HEDGE_MAX_RATIO = 0.1  # ヘッジ要求: 追加で出す要求の上限（全呼び出しに対する割合）
+BREAKER_RESET_TIMEOUT = 30.0  # サーキットブレーカー: 開いてから試し打ちするまでの秒数
+FALLBACK_ACTION = "Stay"  # LLMが期限内に答えない/失敗した時の行動
+# LLMレスポンスキャッシュ（同一プロンプトの再実行で課金しない）
+CACHE_MAX_ENTRIES = 100000  # これを超えたら最終アクセスが古い順に削除
+CACHE_MAX_AGE = 30 * 24 * 3600  # 秒。これより古いエントリは削除
+
+# ステップログ（JSONLストリーム書き出し）
+LOG_HISTORY = 100  # メモリに保持する直近ステップ数（全履歴はJSONLファイル側）
+LOG_FLUSH_EVERY = 1  # 何ステップごとにflushするか
+LOG_FSYNC_EVERY = 10  # 何ステップごとにfsyncするか（0で無効）
+LOG_KEYFRAME_EVERY = 50  # 差分ログのキーフレーム間隔（0で毎ステップ全量）
+LOG_MEMORY_WINDOW = 3  # ログに残す記憶の件数（to_dictの直近N件）
+TRAJECTORY_HEADER_SIZE = 4096  # 軌跡ファイル先頭のJSONヘッダ領域（バイト、以降は固定長レコード）
+EVENT_ROW_GROUP = 4096  # イベント表を何行ずつ書き出すか（Parquet行グループ/IPCバッチ/NPZパート）
+
+# イベント駆動スケジューラ（ステップのバリア無し）
+TICK_SECONDS = 1.0  # 1ティック（壁時計の秒）
+
 # MBTIパーソナリティ（PIMMUR Profile強化: 現実人口分布反映）
 MBTI_TYPES = [
     "INTJ", "INTP", "ENTJ", "ENTP", "INFJ", "INFP", "ENFJ", "ENFP",
@@ -84,36 +158,240 @@ MBTI_DESCRIPTIONS = {
 }
 
 
+def torus_delta(a: int, b: int, size: int) -> int:
+    """トーラス上で a→b の最短符号付き差分（-size/2 .. size/2）"""
+    d = (b - a) % size
+    return d - size if d > size // 2 else d
+
+
+class SpatialIndex:
+    """トーラス対応の一様グリッド空間インデックス（cell_size四方のバケット）。近傍クエリは周辺セルだけ見る"""
+
+    def __init__(self, size: int, cell_size: int = VIEW_RANGE):
+        self.size = size
+        self.cell_size = max(1, cell_size)
+        self.buckets = {}  # (cx, cy) -> {key: item}
+        self.positions = {}  # key -> (x, y)
+
+    def _cell(self, pos: Tuple[int, int]) -> Tuple[int, int]:
+        return (pos[0] % self.size) // self.cell_size, (pos[1] % self.size) // self.cell_size
+
+    def insert(self, key, pos: Tuple[int, int], item=None):
+        if key in self.positions:
+            self.remove(key)
+        self.positions[key] = pos
+        self.buckets.setdefault(self._cell(pos), {})[key] = item
+
+    def remove(self, key):
+        pos = self.positions.pop(key, None)
+        if pos is None:
+            return
+        cell = self._cell(pos)
+        bucket = self.buckets.get(cell)
+        if bucket is not None:
+            bucket.pop(key, None)
+            if not bucket:
+                del self.buckets[cell]
+
+    def move(self, key, new_pos: Tuple[int, int]):
+        old_pos = self.positions.get(key)
+        if old_pos is None:
+            return
+        old_cell, new_cell = self._cell(old_pos), self._cell(new_pos)
+        self.positions[key] = new_pos
+        if old_cell != new_cell:
+            item = self.buckets[old_cell].pop(key)
+            if not self.buckets[old_cell]:
+                del self.buckets[old_cell]
+            self.buckets.setdefault(new_cell, {})[key] = item
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def __contains__(self, key) -> bool:
+        return key in self.positions
+
+    def query(self, pos: Tuple[int, int], radius: int) -> List[Tuple[object, object, int, int]]:
+        """pos から (トーラス最短) チェビシェフ距離 radius 以内の (key, item, dx, dy) を返す"""
+        x, y = pos
+        cs = self.cell_size
+        cols = {((x + d) % self.size) // cs for d in range(-radius, radius + 1)}
+        rows = {((y + d) % self.size) // cs for d in range(-radius, radius + 1)}
+        found = []
+        for cx in cols:
+            for cy in rows:
+                bucket = self.buckets.get((cx, cy))
+                if not bucket:
+                    continue
+                for key, item in bucket.items():
+                    px, py = self.positions[key]
+                    dx = torus_delta(x, px, self.size)
+                    dy = torus_delta(y, py, self.size)
+                    if abs(dx) <= radius and abs(dy) <= radius:
+                        found.append((key, item, dx, dy))
+        return found
+
+
+class MessageBus:
+    """近傍インデックス経由のメッセージ配信: 送信者ごとに1回だけ文字列を作り、視界内エージェントの受信箱へ同じ参照を配る"""
+
+    def __init__(self, agent_index: SpatialIndex, view_range: int = VIEW_RANGE,
+                 inbox_limit: int = MESSAGE_INBOX_LIMIT):
+        self.agent_index = agent_index
+        self.view_range = view_range
+        self.inbox_limit = inbox_limit
+        self.inboxes = {}  # agent_id -> deque(maxlen=inbox_limit)（次ターンに読む分）
+        self.stats = {'sent': 0, 'delivered': 0, 'dropped': 0}
+
+    def publish(self, sender_id: int, position: Tuple[int, int], message: str):
+        """position の視界内にいる sender以外の全エージェントへ配信"""
+        self.stats['sent'] += 1
+        for recipient_id, _, _, _ in self.agent_index.query(position, self.view_range):
+            if recipient_id == sender_id:
+                continue
+            inbox = self.inboxes.get(recipient_id)
+            if inbox is None:
+                inbox = self.inboxes[recipient_id] = deque(maxlen=self.inbox_limit)
+            elif len(inbox) == self.inbox_limit:
+                self.stats['dropped'] += 1
+            inbox.append(message)
+            self.stats['delivered'] += 1
+
+    def collect(self, agent_id: int) -> List[str]:
+        """受信箱を取り出して空にする（ターン開始時に agent.messages へ移す）"""
+        inbox = self.inboxes.pop(agent_id, None)
+        return list(inbox) if inbox else []
+
+    def discard(self, agent_id: int):
+        self.inboxes.pop(agent_id, None)
+
+
+def torus_offsets(size: int, view_range: int) -> np.ndarray:
+    """視界の1軸ぶんの相対オフセット（トーラス最短、重複なし、昇順）"""
+    d = np.arange(-view_range, view_range + 1) % size
+    d = np.where(d > size // 2, d - size, d)
+    return np.unique(d[np.abs(d) <= view_range])
+
+
+class EnergyGrid(MutableMapping):
+    """size×size のエネルギー層（値0 = 源なし）。(x, y) -> 値 のdict互換ファサードとしても使える"""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.values = np.zeros((size, size), dtype=np.int32)  # [x, y]
+        self._count = 0
+
+    def _xy(self, pos: Tuple[int, int]) -> Tuple[int, int]:
+        return int(pos[0]) % self.size, int(pos[1]) % self.size
+
+    # --- dict互換 (len(energy_sources), items(), pop() など既存呼び出しのため) ---
+    def __len__(self) -> int:
+        return self._count
+
+    def __contains__(self, pos) -> bool:
+        return self.values[self._xy(pos)] != 0
+
+    def __getitem__(self, pos: Tuple[int, int]) -> int:
+        value = int(self.values[self._xy(pos)])
+        if value == 0:
+            raise KeyError(pos)
+        return value
+
+    def __setitem__(self, pos: Tuple[int, int], value: int):
+        xy = self._xy(pos)
+        self._count += (value != 0) - (self.values[xy] != 0)
+        self.values[xy] = value
+
+    def __delitem__(self, pos: Tuple[int, int]):
+        xy = self._xy(pos)
+        if self.values[xy] == 0:
+            raise KeyError(pos)
+        self.values[xy] = 0
+        self._count -= 1
+
+    def __iter__(self):
+        xs, ys = np.nonzero(self.values)
+        return iter(list(zip(xs.tolist(), ys.tolist())))
+
+    # --- 配列API ---
+    def take(self, pos: Tuple[int, int]) -> int:
+        """O(1) 取得して空にする（無ければ0）"""
+        xy = self._xy(pos)
+        value = int(self.values[xy])
+        if value:
+            self.values[xy] = 0
+            self._count -= 1
+        return value
+
+    def place(self, xs: np.ndarray, ys: np.ndarray, value: int):
+        """複数セルへ一括配置（既存の源は上書き）"""
+        xs, ys = xs % self.size, ys % self.size
+        self._count += int(np.count_nonzero(self.values[xs, ys] == 0))
+        self.values[xs, ys] = value
+
+    def positions(self) -> np.ndarray:
+        """全エネルギー源の座標 (k, 2)"""
+        return np.argwhere(self.values != 0)
+
+    def window(self, pos: Tuple[int, int], view_range: int) -> List[Tuple[int, int]]:
+        """pos の視界内にある源の相対座標 (dx, dy)（(dx, dy)昇順）"""
+        offs = torus_offsets(self.size, view_range)
+        x, y = self._xy(pos)
+        sub = self.values[np.ix_((x + offs) % self.size, (y + offs) % self.size)]
+        ix, iy = np.nonzero(sub)
+        return list(zip(offs[ix].tolist(), offs[iy].tolist()))
+
+    def window_batch(self, xs: np.ndarray, ys: np.ndarray, view_range: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """複数位置の視界を一括で取得。戻り値 (行番号, dx, dy) の平坦配列"""
+        offs = torus_offsets(self.size, view_range)
+        gx = (np.asarray(xs)[:, None] + offs[None, :]) % self.size  # (n, w)
+        gy = (np.asarray(ys)[:, None] + offs[None, :]) % self.size
+        sub = self.values[gx[:, :, None], gy[:, None, :]]  # (n, w, w)
+        rows, ix, iy = np.nonzero(sub)
+        return rows, offs[ix], offs[iy]
+
+
 class Environment:
     """グリッド環境とエネルギー源の管理"""
     
     def __init__(self, size: int = 20, energy_spawn_rate: float = ENERGY_SPAWN_RATE):
         self.size = size
         self.energy_spawn_rate = energy_spawn_rate
-        self.energy_sources = {}
+        # エネルギー層: size×size配列（dict互換なので len(energy_sources) 等はそのまま動く）
+        self.energy_sources = EnergyGrid(size)
+        # エージェント視界クエリ用の空間インデックス（key=ID, item=LLMAgent）
+        self.agent_index = SpatialIndex(size)
         
     def spawn_energy(self, count: int = SPAWN_ENERGY_COUNT, num_clusters: int = NUM_CLUSTERS, cluster_radius: int = CLUSTER_RADIUS):
-        cluster_centers = []
-        for _ in range(num_clusters):
-            center_x = random.randint(cluster_radius, self.size - 1 - cluster_radius)
-            center_y = random.randint(cluster_radius, self.size - 1 - cluster_radius)
-            cluster_centers.append((center_x, center_y))
-        new_sources = {}
-        for _ in range(count):
-            center_x, center_y = random.choice(cluster_centers)
-            while True:
-                dx = random.randint(-cluster_radius, cluster_radius)
-                dy = random.randint(-cluster_radius, cluster_radius)
-                new_x = center_x + dx
-                new_y = center_y + dy
-                pos = (new_x, new_y)
-                if self.is_valid_position(pos) and pos not in new_sources:
-                    new_sources[pos] = 10
-                    break
-        self.energy_sources.update(new_sources)
+        """クラスタ中心の周りに count 個を一括サンプリング（同一セル重複は引き直し）"""
+        centers = np.random.randint(cluster_radius, self.size - cluster_radius, size=(num_clusters, 2))
+        # クラスタ範囲の実セル数を超える要求は範囲いっぱいで打ち止め（旧実装は無限ループ）
+        span = np.arange(-cluster_radius, cluster_radius + 1)
+        area_x = (centers[:, 0, None, None] + span[None, :, None]) % self.size
+        area_y = (centers[:, 1, None, None] + span[None, None, :]) % self.size
+        count = min(count, len(np.unique(area_x * self.size + area_y)))
+        chosen = np.empty(0, dtype=np.int64)  # x * size + y
+        while len(chosen) < count:
+            need = count - len(chosen)
+            picks = centers[np.random.randint(num_clusters, size=need)]
+            offsets = np.random.randint(-cluster_radius, cluster_radius + 1, size=(need, 2))
+            cells = (picks + offsets) % self.size
+            codes = np.concatenate([chosen, cells[:, 0] * self.size + cells[:, 1]])
+            _, first = np.unique(codes, return_index=True)
+            chosen = codes[np.sort(first)][:count]  # 先に引いた方を残す
+        self.energy_sources.place(chosen // self.size, chosen % self.size, 10)
     
     def get_energy_at(self, pos: Tuple[int, int]) -> int:
-        return self.energy_sources.pop(pos, 0)
+        return self.energy_sources.take(pos)
+
+    def visible_energy(self, pos: Tuple[int, int], view_range: int) -> List[Tuple[int, int]]:
+        """視界内エネルギー源の相対座標 (dx, dy) 一覧（トーラス最短、並び順固定）"""
+        return self.energy_sources.window(pos, view_range)
+
+    def visible_agents(self, pos: Tuple[int, int], view_range: int) -> List[Tuple['LLMAgent', int, int]]:
+        """視界内の生存エージェント (agent, dx, dy) 一覧（ID順）"""
+        found = self.agent_index.query(pos, view_range)
+        return [(agent, dx, dy) for _, agent, dx, dy in sorted(found, key=lambda f: f[0])]
     
     def is_valid_position(self, pos: Tuple[int, int]) -> bool:
         x, y = pos
@@ -125,22 +403,1501 @@ class Environment:
         if random.random() < self.energy_spawn_rate:
             self.spawn_energy(count=1)  # 1つだけ追加
 
+
+class LLMRequestError(Exception):
+    """APIが200以外を返した時の例外（429/5xxはリトライ対象）"""
+
+    def __init__(self, status: int, message: str, retry_after: Optional[float] = None):
+        super().__init__("HTTP {}: {}".format(status, message))
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self) -> bool:
+        return self.status == 429 or self.status >= 500
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-Afterヘッダ（秒数 or HTTP日付）を待ち秒数に変換"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_reset_duration(value: Optional[str]) -> Optional[float]:
+    """x-ratelimit-reset-* ヘッダ（例: '1s', '6m0s', '20ms'）を秒数に変換"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    units = {'h': 3600.0, 'm': 60.0, 's': 1.0, 'ms': 0.001}
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', value)
+    return sum(float(num) * units[unit] for num, unit in parts) if parts else None
+
+
+class TokenBucket:
+    """トークンバケット（1分あたりの上限を連続補充、容量=1分ぶん）"""
+
+    def __init__(self, rate_per_min: float):
+        self.capacity = float(rate_per_min)
+        self.tokens = self.capacity
+        self.refill_per_sec = rate_per_min / 60.0
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_per_sec)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """amount分のトークンが貯まるまでの秒数（0なら即時）"""
+        self._refill()
+        amount = min(amount, self.capacity)  # 容量超えの要求は満タンで通す
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.refill_per_sec
+
+    def consume(self, amount: float):
+        # 実使用量との差分調整でマイナスもあり得る（その分次の要求が待つ）
+        self._refill()
+        self.tokens -= amount
+
+    def drain(self):
+        """サーバー側が残量0を通知した時に手元の残量も0に合わせる"""
+        self._refill()
+        self.tokens = min(self.tokens, 0.0)
+
+
+class RequestScheduler:
+    """_agent_actとAPIの間に入るスケジューラ: RPM/TPMトークンバケット + 同時実行上限 + 429対応リトライ"""
+
+    def __init__(self, rpm: float = RATE_LIMIT_RPM, tpm: float = RATE_LIMIT_TPM,
+                 max_concurrency: int = MAX_CONCURRENT_REQUESTS, max_retries: int = MAX_RETRIES,
+                 base_delay: float = RETRY_BASE_DELAY, max_delay: float = RETRY_MAX_DELAY):
+        self.request_bucket = TokenBucket(rpm)
+        self.token_bucket = TokenBucket(tpm)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._lock = asyncio.Lock()  # 発行順をFIFOに保つ
+        self._blocked_until = 0.0  # Retry-After/残量0で全体を止める時刻 (monotonic)
+        self._rng = random.Random()  # ジッター用（シード固定のグローバル乱数を消費しない）
+        self.stats = {'requests': 0, 'retries': 0, 'rate_limited': 0, 'failures': 0}
+
+    @staticmethod
+    def estimate_tokens(payload: Dict) -> int:
+        """送信前のトークン見積もり（4文字≒1トークン + 出力上限）"""
+        chars = sum(len(m.get('content', '')) for m in payload.get('messages', []))
+        return chars // 4 + payload.get('max_tokens', 0)
+
+    async def _acquire(self, est_tokens: int):
+        async with self._lock:
+            while True:
+                wait = max(self._blocked_until - time.monotonic(),
+                           self.request_bucket.wait_time(1),
+                           self.token_bucket.wait_time(est_tokens))
+                if wait <= 0:
+                    self.request_bucket.consume(1)
+                    self.token_bucket.consume(est_tokens)
+                    return
+                await asyncio.sleep(wait)
+
+    def _block_for(self, seconds: float):
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+    def observe_headers(self, headers):
+        """x-ratelimit-* ヘッダから残量を読み、枯渇していればリセットまで全体を待たせる"""
+        for kind, bucket in (('requests', self.request_bucket), ('tokens', self.token_bucket)):
+            remaining = headers.get('x-ratelimit-remaining-{}'.format(kind))
+            if remaining is None:
+                continue
+            try:
+                exhausted = float(remaining) <= 0
+            except ValueError:
+                continue
+            if exhausted:
+                bucket.drain()
+                reset = _parse_reset_duration(headers.get('x-ratelimit-reset-{}'.format(kind)))
+                if reset:
+                    self._block_for(reset)
+
+    def _backoff(self, attempt: int, retry_after: Optional[float]) -> float:
+        # フルジッター指数バックオフ（Retry-Afterがあればそれ以上待つ）
+        delay = self._rng.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        if retry_after is not None:
+            delay = retry_after + self._rng.uniform(0, self.base_delay)
+        return delay
+
+    async def submit(self, send, payload: Dict, admit=None) -> str:
+        """send(payload) -> (content, usage_tokens) をレート制限内で実行。リトライ上限超過時は最後の例外を送出
+
+        admit() は各試行の前（トークン消費/カウントより前）に呼ばれ、例外を投げればその試行は送らずに中断する。
+        """
+        est_tokens = self.estimate_tokens(payload)
+        for attempt in range(self.max_retries + 1):
+            if admit is not None:
+                admit()
+            await self._acquire(est_tokens)
+            retry_after = None
+            try:
+                async with self._semaphore:
+                    self.stats['requests'] += 1
+                    content, used_tokens = await send(payload)
+                if used_tokens:
+                    self.token_bucket.consume(used_tokens - est_tokens)  # 実使用量で補正
+                return content
+            except LLMRequestError as e:
+                if not e.retryable or attempt >= self.max_retries:
+                    self.stats['failures'] += 1
+                    raise
+                if e.status == 429:
+                    self.stats['rate_limited'] += 1
+                retry_after = e.retry_after
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt >= self.max_retries:
+                    self.stats['failures'] += 1
+                    raise
+            delay = self._backoff(attempt, retry_after)
+            if retry_after is not None:
+                self._block_for(delay)  # 429は全体で待つ
+            self.stats['retries'] += 1
+            await asyncio.sleep(delay)
+
+
+class ResponseCache:
+    """SQLite永続のLLMレスポンスキャッシュ（キー = model/プロンプト/max_tokens/サンプリング設定のハッシュ）"""
+
+    EVICT_EVERY = 100  # put何回ごとに掃除するか
+
+    def __init__(self, path: str, max_entries: int = CACHE_MAX_ENTRIES, max_age: float = CACHE_MAX_AGE):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        # 並列run(multiprocessing)から同じファイルを使うのでWAL + 待ちタイムアウト
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON responses(last_access)")
+        self.conn.commit()
+        self._puts = 0
+        self.stats = {'hits': 0, 'misses': 0, 'evicted': 0}
+
+    @staticmethod
+    def make_key(payload: Dict) -> str:
+        messages = payload.get('messages', [])
+        system_prompt = next((m['content'] for m in messages if m.get('role') == 'system'), "")
+        user_prompt = "\n".join(m['content'] for m in messages if m.get('role') != 'system')
+        sampling = {k: v for k, v in payload.items() if k not in ('model', 'messages', 'max_tokens')}
+        material = json.dumps([payload.get('model'), system_prompt, user_prompt, payload.get('max_tokens'), sampling],
+                              sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        row = self.conn.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None or (self.max_age and now - row[1] > self.max_age):
+            self.stats['misses'] += 1
+            return None
+        self.conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+        self.conn.commit()
+        self.stats['hits'] += 1
+        return row[0]
+
+    def put(self, key: str, response: str):
+        now = time.time()
+        self.conn.execute("INSERT OR REPLACE INTO responses (key, response, created_at, last_access) VALUES (?, ?, ?, ?)",
+                          (key, response, now, now))
+        self.conn.commit()
+        self._puts += 1
+        if self._puts % self.EVICT_EVERY == 0:
+            self.evict()
+
+    def evict(self):
+        """期限切れ削除 + 件数上限を超えた分を最終アクセスが古い順に削除"""
+        evicted = 0
+        if self.max_age:
+            evicted += self.conn.execute("DELETE FROM responses WHERE created_at < ?",
+                                         (time.time() - self.max_age,)).rowcount
+        count = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        if self.max_entries and count > self.max_entries:
+            evicted += self.conn.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_access LIMIT ?)",
+                (count - self.max_entries,)).rowcount
+        self.conn.commit()
+        self.stats['evicted'] += evicted
+
+    def close(self):
+        self.conn.close()
+
+
+def create_http_session(pool_limit: int = HTTP_POOL_LIMIT, pool_limit_per_host: int = HTTP_POOL_LIMIT_PER_HOST,
+                        dns_cache_ttl: int = HTTP_DNS_CACHE_TTL, keepalive_timeout: float = HTTP_KEEPALIVE_TIMEOUT,
+                        timeout: float = HTTP_TIMEOUT) -> aiohttp.ClientSession:
+    """Keep-Alive付きコネクションプールのセッションを作成（イベントループ内で呼ぶこと）"""
+    connector = aiohttp.TCPConnector(
+        limit=pool_limit,
+        limit_per_host=pool_limit_per_host,
+        ttl_dns_cache=dns_cache_ttl,
+        keepalive_timeout=keepalive_timeout
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout))
+
+
+class CircuitOpenError(Exception):
+    """サーキットブレーカーが開いている間の呼び出し（送信せずに即失敗、リトライしない）"""
+
+
+class CircuitBreaker:
+    """エンドポイント単位のサーキットブレーカー
+
+    5xx/通信エラーが failure_threshold 回続いたら開き（以降は送信せずCircuitOpenError）、reset_timeout 秒後に
+    1本だけ試す（半開）。試しが成功すれば閉じ、失敗すればまた開く。429/4xxは障害として数えない。
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'  # 'closed' | 'open' | 'half_open'
+        self.failures = 0  # 連続失敗数
+        self.opened_at = 0.0
+        self._probing = False  # 半開で試し打ち中
+        self.stats = {'opened': 0, 'rejected': 0, 'probes': 0}
+
+    def before_call(self):
+        """送信してよければ戻る。開いている間（半開で試し打ち中を含む）はCircuitOpenError"""
+        if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = 'half_open'
+        if self.state == 'open' or (self.state == 'half_open' and self._probing):
+            self.stats['rejected'] += 1
+            raise CircuitOpenError("circuit open (consecutive failures: {})".format(self.failures))
+        if self.state == 'half_open':
+            self._probing = True
+            self.stats['probes'] += 1
+
+    def record(self, ok: Optional[bool]):
+        """呼び出し結果: True=成功 / False=エンドポイント障害 / None=判定しない（429/4xx/キャンセル）"""
+        self._probing = False
+        if ok:
+            self.state, self.failures = 'closed', 0
+        elif ok is False:
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    self.stats['opened'] += 1
+                self.state, self.opened_at = 'open', time.monotonic()
+
+
+class RequestHedger:
+    """ヘッジ要求: 観測済みレイテンシの percentile を過ぎても返らなければ同じ要求をもう1本出し、先に成功した方を使う
+
+    追加の要求は全呼び出しの max_ratio までに抑える（遅延の裾だけを切り、負荷を倍にしない）。
+    """
+
+    def __init__(self, percentile: float = 95, min_samples: int = HEDGE_MIN_SAMPLES, max_ratio: float = HEDGE_MAX_RATIO):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.max_ratio = max_ratio
+        self.latency = LatencyHistogram()  # 成功した呼び出しの所要時間（最初の送信から）
+        self.stats = {'calls': 0, 'hedged': 0, 'hedge_wins': 0}
+
+    def delay(self) -> Optional[float]:
+        """この呼び出しでヘッジを出すまでの秒数（Noneなら出さない）"""
+        if self.latency.count < self.min_samples or self.stats['hedged'] >= self.max_ratio * self.stats['calls']:
+            return None
+        return self.latency.percentile(self.percentile)
+
+    async def run(self, call) -> str:
+        """call() は1本分の要求を返すコルーチン関数。両方失敗したら最後の例外を送出"""
+        self.stats['calls'] += 1
+        started = time.monotonic()
+        delay = self.delay()
+        tasks = [asyncio.ensure_future(call())]
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done:
+                    self.stats['hedged'] += 1
+                    tasks.append(asyncio.ensure_future(call()))
+            pending, error = set(tasks), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    error = task.exception()
+                    if error is None:
+                        self.latency.record(time.monotonic() - started)
+                        if task is not tasks[0]:
+                            self.stats['hedge_wins'] += 1
+                        return task.result()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+
+class GrokClient:
+    """Grok API (OpenAI互換) クライアント: 1シミュレーション内の全エージェントで接続プールを共有"""
+
+    def __init__(self, api_key: str, api_url: str = API_URL, session: Optional[aiohttp.ClientSession] = None,
+                 pool_limit: int = HTTP_POOL_LIMIT, pool_limit_per_host: int = HTTP_POOL_LIMIT_PER_HOST,
+                 dns_cache_ttl: int = HTTP_DNS_CACHE_TTL, scheduler: Optional[RequestScheduler] = None,
+                 cache: Optional[ResponseCache] = None, hedger: Optional[RequestHedger] = None,
+                 breaker: Optional[CircuitBreaker] = None):
+        self.api_key = api_key
+        self.scheduler = scheduler or RequestScheduler()
+        self.cache = cache
+        self.hedger = hedger  # 指定時は遅い呼び出しに重複要求を出す
+        self.breaker = breaker  # 指定時は障害中のエンドポイントへ送らない
+        self.api_url = api_url
+        self.pool_limit = pool_limit
+        self.pool_limit_per_host = pool_limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self._session = session
+        self._owns_session = session is None  # 外部から渡されたセッションは閉じない
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # 遅延生成: asyncio.run()ごとに別ループになるStreamlit実行でも安全
+        if self._session is None or self._session.closed:
+            self._session = create_http_session(self.pool_limit, self.pool_limit_per_host, self.dns_cache_ttl)
+            self._owns_session = True
+        return self._session
+
+    async def _post(self, payload: Dict) -> Tuple[str, int]:
+        """chat/completionsを1回呼ぶ（本文, 使用トークン数）。200以外はLLMRequestError"""
+        ok = None
+        try:
+            headers = {"Authorization": f"Bearer {self.api_key}"}
+            async with self.session.post(self.api_url, json=payload, headers=headers) as resp:
+                self.scheduler.observe_headers(resp.headers)
+                if resp.status != 200:
+                    ok = False if resp.status >= 500 else None
+                    raise LLMRequestError(resp.status, (await resp.text())[:200],
+                                          retry_after=_parse_retry_after(resp.headers.get('Retry-After')))
+                result = await resp.json()
+                ok = True
+                return result['choices'][0]['message']['content'], result.get('usage', {}).get('total_tokens', 0)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            ok = False
+            raise
+        finally:
+            if self.breaker is not None:
+                self.breaker.record(ok)
+
+    async def _submit(self, payload: Dict) -> str:
+        # ブレーカーは各試行のレート制限待ちより前に判定（開いていればトークンもリクエスト数も使わずCircuitOpenError）
+        admit = self.breaker.before_call if self.breaker is not None else None
+        if self.hedger is None:
+            return await self.scheduler.submit(self._post, payload, admit=admit)
+        return await self.hedger.run(lambda: self.scheduler.submit(self._post, payload, admit=admit))
+
+    async def chat(self, payload: Dict) -> str:
+        """レート制限/リトライ付きでchat/completionsを呼び、アシスタントの本文を返す（キャッシュ優先）"""
+        if self.cache is None:
+            return await self._submit(payload)
+        key = self.cache.make_key(payload)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        content = await self._submit(payload)
+        self.cache.put(key, content)
+        return content
+
+    async def close(self):
+        """自前で作ったプールのみクローズ（共有セッションは呼び出し元が閉じる）"""
+        if self._owns_session and self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+
+
+class DecisionRecorder:
+    """LLM生レスポンスを (run_id, step, agent_id) ごとにJSONLで記録（seq = ステップ内の行動適用順）"""
+
+    def __init__(self, path: str, run_id: int = 0):
+        self.path = path
+        self.run_id = run_id
+        self._file = open(path, 'w', encoding='utf-8')
+        self._seq = {}  # step -> 次のseq
+
+    def record(self, step: int, agent_id: int, response: str):
+        seq = self._seq.get(step, 0)
+        self._seq[step] = seq + 1
+        self._file.write(json.dumps({'run_id': self.run_id, 'step': step, 'agent_id': agent_id,
+                                     'seq': seq, 'response': response}, ensure_ascii=False) + "\n")
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+
+class DecisionReplayer:
+    """DecisionRecorderの記録を読み込み、ネットワーク無しで同じレスポンスを同じ適用順で返す"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.responses = {}  # (step, agent_id) -> response
+        self._order = {}  # step -> [(seq, agent_id)]
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                rec = json.loads(line)
+                self.responses[(rec['step'], rec['agent_id'])] = rec['response']
+                self._order.setdefault(rec['step'], []).append((rec['seq'], rec['agent_id']))
+        self.misses = 0
+
+    def get(self, step: int, agent_id: int) -> Optional[str]:
+        response = self.responses.get((step, agent_id))
+        if response is None:
+            self.misses += 1
+        return response
+
+    def order(self, step: int) -> List[int]:
+        """記録時にこのステップで行動が適用されたエージェントID順"""
+        return [agent_id for _, agent_id in sorted(self._order.get(step, []))]
+
+
+class AgentStore:
+    """エージェント数値状態のStruct-of-Arrays（連続NumPy列）。集計/エネルギー消費/死亡判定を全体一括で計算する"""
+
+    def __init__(self, capacity: int = 64):
+        self.size = 0  # 割り当て済みスロット数
+        self.ids = np.zeros(capacity, dtype=np.int64)  # スロット -> エージェントID
+        self.x = np.zeros(capacity, dtype=np.int32)
+        self.y = np.zeros(capacity, dtype=np.int32)
+        self.energy = np.zeros(capacity, dtype=np.int64)
+        self.age = np.zeros(capacity, dtype=np.int64)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.mbti = np.full(capacity, -1, dtype=np.int8)  # MBTI_TYPESのインデックス
+        self.parent = np.full(capacity, -1, dtype=np.int64)  # 親ID（-1 = なし）
+        self._free = []  # 死亡で解放されたスロット（再利用して配列を最大同時生存数に抑える）
+
+    COLUMNS = ('ids', 'x', 'y', 'energy', 'age', 'alive', 'mbti', 'parent')
+
+    @property
+    def capacity(self) -> int:
+        return len(self.ids)
+
+    def _grow(self):
+        new_capacity = self.capacity * 2
+        for name in self.COLUMNS:
+            old = getattr(self, name)
+            fill = -1 if name in ('mbti', 'parent') else 0
+            new = np.full(new_capacity, fill, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def allocate(self, agent_id: int, position: Tuple[int, int], energy: int, age: int, alive: bool,
+                 mbti_type: Optional[str], parent_id: Optional[int]) -> int:
+        """1エージェント分のスロットを確保して初期値を書き込む"""
+        if self._free:
+            slot = self._free.pop()
+        else:
+            if self.size == self.capacity:
+                self._grow()
+            slot = self.size
+            self.size += 1
+        self.ids[slot] = agent_id
+        self.x[slot], self.y[slot] = position
+        self.energy[slot] = energy
+        self.age[slot] = age
+        self.alive[slot] = alive
+        self.mbti[slot] = MBTI_TYPES.index(mbti_type) if mbti_type in MBTI_TYPES else -1
+        self.parent[slot] = -1 if parent_id is None else parent_id
+        return slot
+
+    def release(self, slot: int):
+        """スロットを空きに戻す（呼び出し側は先にLLMAgent.detach()で値を退避すること）"""
+        self.alive[slot] = False
+        self.mbti[slot] = -1
+        self._free.append(slot)
+
+    def living_slots(self) -> np.ndarray:
+        return np.flatnonzero(self.alive[:self.size])
+
+    def charge(self, slots: np.ndarray, costs: np.ndarray) -> np.ndarray:
+        """slots のエネルギーから costs を一括で引き、0以下になったスロットを返す"""
+        self.energy[slots] -= costs
+        return slots[self.energy[slots] <= 0]
+
+    def population_stats(self) -> Dict:
+        """生存者の集計（人数/総エネルギー/平均・最大年齢/MBTI別人数）をベクトル演算で"""
+        live = self.alive[:self.size]
+        count = int(live.sum())
+        ages = self.age[:self.size][live]
+        codes = self.mbti[:self.size][live]
+        mbti_counts = np.bincount(codes[codes >= 0], minlength=len(MBTI_TYPES))
+        return {
+            'alive': count,
+            'total_energy': int(self.energy[:self.size][live].sum()),
+            'avg_age': float(ages.mean()) if count else 0,
+            'max_age': int(ages.max()) if count else 0,
+            'mbti_counts': {t: int(c) for t, c in zip(MBTI_TYPES, mbti_counts)}
+        }
+
+
+class AgentRegistry:
+    """エージェント台帳: IDでO(1)参照・生存者の集合・死亡個体のコンパクトな記録"""
+
+    ARCHIVE_FIELDS = ('id', 'mbti_type', 'parent', 'died_step', 'age', 'energy', 'position', 'num_descendants')
+
+    def __init__(self, store: Optional[AgentStore] = None):
+        self.store = store
+        self.active = {}  # id -> LLMAgent（生存者 + このステップで死んだ未整理の個体、生成順）
+        self.next_id = 0  # 次に割り当てるID（= これまでに生まれた総数）
+        self.archive = {field: [] for field in self.ARCHIVE_FIELDS}  # 死亡個体の列指向レコード
+
+    def add(self, agent: 'LLMAgent'):
+        self.active[agent.id] = agent
+        self.next_id = max(self.next_id, agent.id + 1)
+
+    def get(self, agent_id: int) -> Optional['LLMAgent']:
+        """生存中のエージェントをIDで取得（死亡/不明はNone）"""
+        agent = self.active.get(agent_id)
+        return agent if agent is not None and agent.alive else None
+
+    def living(self) -> List['LLMAgent']:
+        return [a for a in self.active.values() if a.alive]
+
+    def compact(self, step: int) -> int:
+        """死亡個体を台帳から外してレコード化（ストアのスロットも解放）。整理した数を返す"""
+        dead = [a for a in self.active.values() if not a.alive]
+        for agent in dead:
+            del self.active[agent.id]
+            slot = agent.detach()
+            if self.store is not None and slot >= 0:
+                self.store.release(slot)
+            row = (agent.id, agent.mbti_type, agent.parent.id if agent.parent else None, step,
+                   agent.age, agent.energy, agent.position, len(agent.descendants))
+            for field, value in zip(self.ARCHIVE_FIELDS, row):
+                self.archive[field].append(value)
+        return len(dead)
+
+    def archived_records(self) -> List[Dict]:
+        """死亡個体レコードを行形式で返す（JSON出力用）"""
+        columns = [self.archive[field] for field in self.ARCHIVE_FIELDS]
+        return [dict(zip(self.ARCHIVE_FIELDS, row)) for row in zip(*columns)]
+
+    def __len__(self) -> int:
+        return len(self.active)
+
+
+class LatencyHistogram:
+    """対数バケットの遅延ヒストグラム（相対誤差 約2.5%）。記録はO(1)、分位点はバケットの走査だけ"""
+
+    GROWTH = 1.05
+    FLOOR = 1e-7  # 0.1µs未満は最下段
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+        self._buckets = {}
+
+    def record(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        bucket = int(math.log(max(seconds, self.FLOOR) / self.FLOOR, self.GROWTH))
+        self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+
+    def percentile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q / 100 * self.count
+        seen = 0
+        for bucket in sorted(self._buckets):
+            seen += self._buckets[bucket]
+            if seen >= rank:
+                mid = self.FLOOR * self.GROWTH ** (bucket + 0.5)
+                return min(max(mid, self.min), self.max)
+        return self.max
+
+    def summary(self) -> Dict:
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else 0.0,
+            'min': self.min if self.count else 0.0,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+        }
+
+
+class StepProfiler:
+    """Simulation.step のフェーズ別タイマー（opt-in）。ステップ内の区切りは lap、エージェント単位は record_agent
+
+    エージェント単位のフェーズ（local_view/build_prompt/llm/apply）は並行実行なので合計は壁時計を超えうる。
+    壁時計は 'agents' フェーズを見る。
+    """
+
+    AGENT_PHASES = ('local_view', 'build_prompt', 'llm', 'apply')
+
+    def __init__(self):
+        self.phases = {}  # フェーズ名 -> LatencyHistogram
+        self.agent_llm = {}  # エージェントID -> [呼び出し数, 合計秒]
+        self.steps = 0
+        self._step_start = self._mark = time.perf_counter()
+
+    def record(self, phase: str, seconds: float):
+        hist = self.phases.get(phase)
+        if hist is None:
+            hist = self.phases[phase] = LatencyHistogram()
+        hist.record(seconds)
+
+    def start_step(self):
+        self._step_start = self._mark = time.perf_counter()
+
+    def lap(self, phase: str):
+        """直前の区切りからの経過を phase として記録"""
+        now = time.perf_counter()
+        self.record(phase, now - self._mark)
+        self._mark = now
+
+    def end_step(self):
+        self.lap('log')
+        self.record('step', self._mark - self._step_start)
+        self.steps += 1
+
+    def record_agent(self, agent_id: int, timings: Tuple[float, ...]):
+        for phase, seconds in zip(self.AGENT_PHASES, timings):
+            self.record(phase, seconds)
+        entry = self.agent_llm.setdefault(agent_id, [0, 0.0])
+        entry[0] += 1
+        entry[1] += timings[2]
+
+    def report(self, top_agents: int = 10) -> Dict:
+        phases = {name: hist.summary() for name, hist in
+                  sorted(self.phases.items(), key=lambda kv: kv[1].total, reverse=True)}
+        slowest = sorted(self.agent_llm.items(), key=lambda kv: kv[1][1] / kv[1][0], reverse=True)[:top_agents]
+        return {
+            'steps': self.steps,
+            'phases': phases,
+            'slowest_agents_llm': [{'id': agent_id, 'calls': n, 'mean': total / n} for agent_id, (n, total) in slowest],
+        }
+
+    def format_table(self) -> str:
+        """コンソール用の表（ミリ秒）"""
+        lines = ["{:<20}{:>8}{:>11}{:>9}{:>9}{:>9}{:>9}".format('phase', 'count', 'total_s', 'mean', 'p50', 'p95', 'p99')]
+        for name, row in self.report()['phases'].items():
+            lines.append("{:<20}{:>8}{:>11.3f}{:>9.2f}{:>9.2f}{:>9.2f}{:>9.2f}".format(
+                name, row['count'], row['total'], row['mean'] * 1e3, row['p50'] * 1e3, row['p95'] * 1e3, row['p99'] * 1e3))
+        return "\n".join(lines)
+
+    def write(self, path: str):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+ACTION_KINDS = ('Move', 'Stay', 'Share', 'Attack', 'Reproduce', 'Other')
+
+
+class MetricsAccumulator:
+    """生存者集計（人数/エネルギー/年齢/MBTI）と行動数をイベントごとに差分更新する。snapshot は生存者数に依らない
+
+    エネルギーは生存中の個体の増減だけを数える（死亡後に行動した分は AgentStore.population_stats と同じく除外）。
+    """
+
+    def __init__(self):
+        self.alive = 0
+        self.total_energy = 0
+        self.age_sum = 0
+        self.max_age = 0
+        self.mbti_counts = [0] * len(MBTI_TYPES)
+        self._age_counts = {}  # 年齢 -> 生存者数（死亡で最大年齢が変わったときの繰り下げ用）
+        self.total_actions = 0  # 適用したレスポンスの累計（率の分母）
+        self.action_counts = dict.fromkeys(ACTION_KINDS, 0)  # 累計
+        self.step_actions = dict.fromkeys(ACTION_KINDS, 0)  # 現ステップ分
+
+    def _add_age(self, age: int):
+        self._age_counts[age] = self._age_counts.get(age, 0) + 1
+        self.max_age = max(self.max_age, age)
+
+    def _remove_age(self, age: int):
+        self._age_counts[age] -= 1
+        if not self._age_counts[age]:
+            del self._age_counts[age]
+            while self.max_age > 0 and self.max_age not in self._age_counts:
+                self.max_age -= 1
+
+    def _mbti_add(self, mbti_type: Optional[str], n: int):
+        if mbti_type in MBTI_TYPES:
+            self.mbti_counts[MBTI_TYPES.index(mbti_type)] += n
+
+    def begin_step(self):
+        self.step_actions = dict.fromkeys(ACTION_KINDS, 0)
+
+    def on_birth(self, agent: 'LLMAgent'):
+        self.alive += 1
+        self.total_energy += agent.energy
+        self.age_sum += agent.age
+        self._add_age(agent.age)
+        self._mbti_add(agent.mbti_type, 1)
+
+    def on_death(self, agent: 'LLMAgent'):
+        self.alive -= 1
+        self.total_energy -= agent.energy
+        self.age_sum -= agent.age
+        self._remove_age(agent.age)
+        self._mbti_add(agent.mbti_type, -1)
+
+    def on_energy(self, agent: 'LLMAgent', delta: int):
+        if agent.alive:
+            self.total_energy += delta
+
+    def on_charge(self, total: int):
+        """生存者の維持コスト（行動コストの合計）をまとめて引く。死亡済みの個体の分は呼び出し側で除く"""
+        self.total_energy -= total
+
+    def on_age(self, agent: 'LLMAgent', old_age: int):
+        if agent.alive:
+            self.age_sum += agent.age - old_age
+            self._remove_age(old_age)
+            self._add_age(agent.age)
+
+    def on_action(self, action: str):
+        kind = next((k for k in ACTION_KINDS[:-1] if action.startswith(k)), 'Other')
+        self.action_counts[kind] += 1
+        self.step_actions[kind] += 1
+        self.total_actions += 1
+
+    def snapshot(self) -> Dict:
+        """AgentStore.population_stats と同じキー + 行動数"""
+        return {
+            'alive': self.alive,
+            'total_energy': self.total_energy,
+            'avg_age': self.age_sum / self.alive if self.alive else 0,
+            'max_age': self.max_age,
+            'mbti_counts': dict(zip(MBTI_TYPES, self.mbti_counts)),
+            'total_actions': self.total_actions,
+            'action_counts': dict(self.action_counts),
+            'step_actions': dict(self.step_actions),
+        }
+
+    def mbti_distribution(self) -> Dict[str, float]:
+        return {t: c / self.alive if self.alive else 0 for t, c in zip(MBTI_TYPES, self.mbti_counts)}
+
+    def rates(self, stats: Dict) -> Dict[str, float]:
+        """協力/攻撃/生殖率（分母は実際に適用した行動の累計）"""
+        n = self.total_actions
+        return {
+            'coop_rate': stats['shares'] / n if n else 0,
+            'attack_rate': stats['attacks'] / n if n else 0,
+            'repro_rate': stats['reproductions'] / n if n else 0,
+        }
+
+
+LOG_SUFFIXES = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+
+def _compression_from_path(path: str) -> Optional[str]:
+    if str(path).endswith('.gz'):
+        return 'gzip'
+    if str(path).endswith('.zst'):
+        return 'zstd'
+    return None
+
+
+class StepDeltaEncoder:
+    """ステップログの差分化: Kステップごとに全量（kind=key）、間は変化したフィールドだけ（kind=delta）
+
+    delta の agents は {'id', 変化したフィールド...}。新規個体は全フィールド、消えた個体は removed に入る。
+    memory/descendants は末尾に足された分だけ（'memory+' / 'descendants+'）を書く。
+    受信メッセージは同じ送信文が近傍全員に届くので、レコードごとの message_table への番号にする。
+    """
+
+    def __init__(self, keyframe_every: int = LOG_KEYFRAME_EVERY):
+        self.keyframe_every = keyframe_every
+        self.records = 0
+        self._prev = {}  # id -> 直前ステップのエージェント辞書
+
+    def encode(self, record: Dict) -> Dict:
+        agents = record['agents']
+        current = {a['id']: a for a in agents}
+        rest = {k: v for k, v in record.items() if k not in ('step', 'agents')}
+        if not self.keyframe_every or self.records % self.keyframe_every == 0:
+            out = {'step': record['step'], 'kind': 'key', 'agents': agents}
+        else:
+            changed = []
+            for a in agents:
+                old = self._prev.get(a['id'])
+                diff = a if old is None else self._diff(old, a)
+                if len(diff) > 1:
+                    changed.append(diff)
+            removed = [i for i in self._prev if i not in current]
+            out = {'step': record['step'], 'kind': 'delta', 'agents': changed, 'removed': removed}
+        table = {}
+        out['agents'] = [self._intern_messages(a, table) for a in out['agents']]
+        out['message_table'] = list(table)
+        out.update(rest)
+        self._prev = current
+        self.records += 1
+        return out
+
+    @staticmethod
+    def _intern_messages(agent: Dict, table: Dict[str, int]) -> Dict:
+        if not agent.get('messages'):
+            return agent
+        agent = dict(agent)  # 元の辞書（メモリ上のログ）は書き換えない
+        agent['messages'] = [table.setdefault(m, len(table)) for m in agent['messages']]
+        return agent
+
+    @staticmethod
+    def _diff(old: Dict, new: Dict) -> Dict:
+        diff = {'id': new['id']}
+        for key, value in new.items():
+            before = old.get(key)
+            if key == 'id' or before == value:
+                continue
+            if key == 'memory' and before is not None:
+                # 記憶は「直前の窓 + 追加分」の末尾N件になっていることが多い
+                for k in range(1, len(value)):
+                    if (before + value[-k:])[-LOG_MEMORY_WINDOW:] == value:
+                        diff['memory+'] = value[-k:]
+                        break
+                else:
+                    diff[key] = value
+            elif key == 'descendants' and before is not None and value[:len(before)] == before:
+                diff['descendants+'] = value[len(before):]
+            else:
+                diff[key] = value
+        return diff
+
+
+class StepDeltaDecoder:
+    """StepDeltaEncoderの逆。レコードを先頭（または任意のキーフレーム）から順に渡すと全量の状態を返す"""
+
+    def __init__(self):
+        self._state = None  # id -> エージェント辞書（挿入順 = ログの並び順）
+
+    def decode(self, record: Dict) -> Dict:
+        kind = record.get('kind')
+        if kind is None:
+            return record  # 差分化していない従来形式
+        rest = {k: v for k, v in record.items() if k not in ('kind', 'agents', 'removed', 'message_table')}
+        table = record.get('message_table', [])
+        agents = []
+        for a in record['agents']:
+            if a.get('messages'):
+                a = dict(a, messages=[table[i] for i in a['messages']])
+            agents.append(a)
+        if kind == 'key':
+            self._state = {a['id']: a for a in agents}
+        else:
+            if self._state is None:
+                raise ValueError("delta record at step {} without a preceding keyframe".format(record['step']))
+            for agent_id in record.get('removed', []):
+                self._state.pop(agent_id, None)
+            for diff in agents:
+                agent = dict(self._state.get(diff['id'], {}))
+                for key, value in diff.items():
+                    if key == 'memory+':
+                        agent['memory'] = (agent['memory'] + value)[-LOG_MEMORY_WINDOW:]
+                    elif key == 'descendants+':
+                        agent['descendants'] = agent['descendants'] + value
+                    else:
+                        agent[key] = value
+                self._state[diff['id']] = agent
+        rest['agents'] = [dict(a) for a in self._state.values()]
+        return rest
+
+
+class StepLogWriter:
+    """1ステップ = 1行のJSONLを追記（gzip/zstd対応）。一定間隔でflush/fsyncするのでクラッシュ時も直前まで残る
+
+    keyframe_every > 0 なら差分形式（StepDeltaEncoder）で書く。read_step_log は両形式を全量に戻して返す。
+    """
+
+    def __init__(self, path: str, compression: Optional[str] = None,
+                 flush_every: int = LOG_FLUSH_EVERY, fsync_every: int = LOG_FSYNC_EVERY,
+                 keyframe_every: int = 0):
+        if compression not in LOG_SUFFIXES:
+            raise ValueError("Unknown log compression: {}".format(compression))
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError("log_compression='zstd' requires the zstandard package (pip install zstandard)")
+        self.path = path
+        self.compression = compression
+        self.flush_every = max(1, flush_every)
+        self.fsync_every = fsync_every
+        self.records = 0
+        self._encoder = StepDeltaEncoder(keyframe_every) if keyframe_every else None
+        self._raw = open(path, 'wb')
+        if compression == 'gzip':
+            self._stream = gzip.GzipFile(fileobj=self._raw, mode='wb')
+        elif compression == 'zstd':
+            self._stream = zstandard.ZstdCompressor().stream_writer(self._raw, closefd=False)
+        else:
+            self._stream = self._raw
+
+    def write(self, record: Dict):
+        if self._encoder is not None:
+            record = self._encoder.encode(record)
+        self._stream.write((json.dumps(record, ensure_ascii=False) + "\n").encode('utf-8'))
+        self.records += 1
+        if self.records % self.flush_every == 0:
+            self.flush(fsync=bool(self.fsync_every) and self.records % self.fsync_every == 0)
+
+    def flush(self, fsync: bool = False):
+        # 圧縮ストリームは同期フラッシュ（ここまでを単独で解凍可能にする）
+        if self.compression == 'zstd':
+            self._stream.flush(zstandard.FLUSH_BLOCK)
+        elif self.compression == 'gzip':
+            self._stream.flush()
+        self._raw.flush()
+        if fsync:
+            os.fsync(self._raw.fileno())
+
+    def close(self):
+        if self._raw.closed:
+            return
+        self.flush(fsync=bool(self.fsync_every))
+        if self._stream is not self._raw:
+            self._stream.close()
+        self._raw.close()
+
+
+def read_step_log(path: str):
+    """StepLogWriterのファイルを1ステップずつ読む（圧縮は拡張子で判定、途中で切れた末尾は無視、差分は全量に復元）"""
+    decoder = StepDeltaDecoder()
+    for record in _read_log_records(path):
+        yield decoder.decode(record)
+
+
+_LOG_RECORD_HEAD = re.compile(r'^\{"step": (\d+), "kind": "(key|delta)"')
+
+
+def read_step(path: str, step: int) -> Optional[Dict]:
+    """任意ステップの全量状態を復元（直前のキーフレーム以降だけをJSONとして解釈する）"""
+    pending = []
+    for line in _read_log_lines(path):
+        head = _LOG_RECORD_HEAD.match(line)
+        if head is None:
+            record = json.loads(line)  # 従来形式（全量）
+            if record['step'] == step:
+                return record
+            continue
+        line_step, kind = int(head.group(1)), head.group(2)
+        if kind == 'key':
+            pending = []
+        pending.append(line)
+        if line_step == step:
+            decoder = StepDeltaDecoder()
+            state = None
+            for raw in pending:
+                state = decoder.decode(json.loads(raw))
+            return state
+    return None
+
+
+def _read_log_records(path: str):
+    for line in _read_log_lines(path):
+        yield json.loads(line)
+
+
+def _read_log_lines(path: str):
+    compression = _compression_from_path(path)
+    if compression == 'gzip':
+        f = gzip.open(path, 'rt', encoding='utf-8')
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise ImportError("reading .zst logs requires the zstandard package")
+        f = io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True),
+                             encoding='utf-8')
+    else:
+        f = open(path, encoding='utf-8')
+    # 途中で切れた圧縮ストリームの例外は「ここまで」として扱う
+    truncated = (EOFError, zlib.error) + ((zstandard.ZstdError,) if zstandard is not None else ())
+    with f:
+        try:
+            for line in f:
+                if not line.endswith("\n"):
+                    break  # 書きかけの行
+                yield line
+        except truncated:
+            return
+
+
+# イベント表スキーマ: 表名 -> [(列名, 型)]。型は 'int' | 'bool' | 'str'
+EVENT_SCHEMAS = {
+    'attack': [('step', 'int'), ('attacker', 'int'), ('target', 'int'), ('amount', 'int'), ('target_died', 'bool')],
+    'share': [('step', 'int'), ('giver', 'int'), ('receiver', 'int'), ('amount', 'int')],
+    'birth': [('step', 'int'), ('child', 'int'), ('parent', 'int'), ('mbti_type', 'str'), ('parent_mbti_type', 'str')],
+    'death': [('step', 'int'), ('agent', 'int'), ('cause', 'str'), ('age', 'int'), ('energy', 'int')],
+    'pickup': [('step', 'int'), ('agent', 'int'), ('x', 'int'), ('y', 'int'), ('amount', 'int')],
+}
+EVENT_FORMATS = {'parquet': '.parquet', 'arrow': '.arrow', 'npz': '.npz'}
+
+
+class EventLog:
+    """型付き・追記専用のイベント表（攻撃/共有/誕生/死亡/取得）。行グループ単位で列指向ファイルへ書き出す"""
+
+    def __init__(self, directory: str, fmt: str = 'auto', row_group_size: int = EVENT_ROW_GROUP):
+        if fmt == 'auto':
+            fmt = 'parquet' if pa is not None else 'npz'
+        if fmt not in EVENT_FORMATS:
+            raise ValueError("Unknown event format: {}".format(fmt))
+        if fmt in ('parquet', 'arrow') and pa is None:
+            raise ImportError("event_format='{}' requires pyarrow (pip install pyarrow)".format(fmt))
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.fmt = fmt
+        self.row_group_size = max(1, row_group_size)
+        self._buffers = {table: [] for table in EVENT_SCHEMAS}
+        self._writers = {}  # parquet/arrow: 表名 -> writer
+        self._parts = {table: 0 for table in EVENT_SCHEMAS}  # npz: 書き出し済みパート数
+        self.counts = {table: 0 for table in EVENT_SCHEMAS}
+
+    def emit(self, table: str, *row):
+        """1行追加（値はEVENT_SCHEMASの列順）"""
+        buffer = self._buffers[table]
+        buffer.append(row)
+        self.counts[table] += 1
+        if len(buffer) >= self.row_group_size:
+            self._flush_table(table)
+
+    def _columns(self, table: str, rows: List[tuple]) -> Dict[str, np.ndarray]:
+        columns = {}
+        for i, (name, kind) in enumerate(EVENT_SCHEMAS[table]):
+            values = [row[i] for row in rows]
+            if kind == 'int':
+                columns[name] = np.array([-1 if v is None else v for v in values], dtype=np.int64)
+            elif kind == 'bool':
+                columns[name] = np.array(values, dtype=bool)
+            else:
+                columns[name] = np.array(['' if v is None else str(v) for v in values], dtype=str)
+        return columns
+
+    def _flush_table(self, table: str):
+        rows = self._buffers[table]
+        if not rows:
+            return
+        self._buffers[table] = []
+        columns = self._columns(table, rows)
+        path = self.directory / (table + EVENT_FORMATS[self.fmt])
+        if self.fmt == 'npz':
+            part = self._parts[table]
+            self._parts[table] += 1
+            np.savez(self.directory / '{}.part{:05d}.npz'.format(table, part), **columns)
+            return
+        batch = pa.table({name: pa.array(col) for name, col in columns.items()})
+        writer = self._writers.get(table)
+        if writer is None:
+            if self.fmt == 'parquet':
+                writer = pq.ParquetWriter(str(path), batch.schema)
+            else:
+                writer = pa.ipc.new_file(str(path), batch.schema)
+            self._writers[table] = writer
+        if self.fmt == 'parquet':
+            writer.write_table(batch, row_group_size=self.row_group_size)
+        else:
+            writer.write_table(batch)
+
+    def flush(self):
+        for table in EVENT_SCHEMAS:
+            self._flush_table(table)
+
+    def close(self):
+        self.flush()
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
+
+
+def load_events(directory: str, table: str) -> Dict[str, np.ndarray]:
+    """EventLogの表を列ごとのNumPy配列で読む（形式はファイルから判定）"""
+    directory = Path(directory)
+    names = [name for name, _ in EVENT_SCHEMAS[table]]
+    if (directory / (table + '.parquet')).exists():
+        data = pq.read_table(str(directory / (table + '.parquet')))
+        return {name: data.column(name).to_numpy() for name in names}
+    if (directory / (table + '.arrow')).exists():
+        with pa.memory_map(str(directory / (table + '.arrow'))) as source:
+            data = pa.ipc.open_file(source).read_all()
+        return {name: data.column(name).to_numpy() for name in names}
+    parts = sorted(directory.glob('{}.part*.npz'.format(table)))
+    if not parts:
+        return {name: np.empty(0) for name in names}
+    columns = {name: [] for name in names}
+    for part in parts:
+        with np.load(part) as data:  # NpzFileはzipを開いたままにするので読み終えたら閉じる
+            for name in names:
+                columns[name].append(data[name])
+    return {name: np.concatenate(arrays) for name, arrays in columns.items()}
+
+
+TRAJECTORY_MAGIC = b'SGTRAJ1\n'
+# 1レコード = 1エージェント x 1ステップ（リトルエンディアン・詰め物なし）
+TRAJECTORY_DTYPE = np.dtype([('step', '<i4'), ('id', '<i4'), ('x', '<i2'), ('y', '<i2'), ('energy', '<i4'),
+                             ('age', '<i4'), ('alive', 'u1'), ('mbti', 'i1'), ('parent', '<i4')])
+
+
+class TrajectoryWriter:
+    """数値軌跡（x, y, energy, alive, age）を固定長バイナリへ追記する。np.memmapでそのまま開ける
+
+    レイアウト: MAGIC + JSONヘッダ（TRAJECTORY_HEADER_SIZEまで空白詰め）+ TRAJECTORY_DTYPEのレコード列。
+    レコードはstep昇順に並ぶのでステップ範囲は二分探索で切り出せる。
+    """
+
+    def __init__(self, path: str, grid_size: int, flush_every: int = LOG_FLUSH_EVERY):
+        self.path = Path(path)
+        self.flush_every = max(1, flush_every)
+        self.rows = 0
+        self._pending = 0
+        header = {
+            'version': 1,
+            'header_size': TRAJECTORY_HEADER_SIZE,
+            'record_size': TRAJECTORY_DTYPE.itemsize,
+            'dtype': [(name, TRAJECTORY_DTYPE[name].str) for name in TRAJECTORY_DTYPE.names],
+            'grid_size': grid_size,
+            # エージェントIDの対応: id列 = LLMAgent.id、mbti列 = mbti_typesのインデックス（-1 = なし）、parent列 = 親ID（-1 = なし）
+            'mbti_types': MBTI_TYPES,
+            'order': 'step',
+        }
+        blob = TRAJECTORY_MAGIC + json.dumps(header).encode('utf-8')
+        if len(blob) > TRAJECTORY_HEADER_SIZE:
+            raise ValueError("trajectory header exceeds {} bytes".format(TRAJECTORY_HEADER_SIZE))
+        self._fh = open(self.path, 'wb')
+        self._fh.write(blob.ljust(TRAJECTORY_HEADER_SIZE, b' '))
+
+    def write(self, step: int, agents: List['LLMAgent'], store: Optional['AgentStore'] = None):
+        """1ステップ分（agentsの並び順）を追記。ストアがあれば列から一括で取る"""
+        records = np.zeros(len(agents), dtype=TRAJECTORY_DTYPE)
+        records['step'] = step
+        if store is not None and all(agent.slot >= 0 for agent in agents):
+            slots = np.array([agent.slot for agent in agents], dtype=np.int64)
+            records['id'] = store.ids[slots]
+            records['x'] = store.x[slots]
+            records['y'] = store.y[slots]
+            records['energy'] = store.energy[slots]
+            records['age'] = store.age[slots]
+            records['alive'] = store.alive[slots]
+            records['mbti'] = store.mbti[slots]
+            records['parent'] = store.parent[slots]
+        else:
+            for i, agent in enumerate(agents):
+                records[i] = (step, agent.id, agent.position[0], agent.position[1], agent.energy, agent.age,
+                              agent.alive, MBTI_TYPES.index(agent.mbti_type) if agent.mbti_type in MBTI_TYPES else -1,
+                              agent.parent.id if agent.parent is not None else -1)
+        self._fh.write(records.tobytes())
+        self.rows += len(records)
+        self._pending += 1
+        if self._pending >= self.flush_every:
+            self._fh.flush()
+            self._pending = 0
+
+    def close(self):
+        if not self._fh.closed:
+            self._fh.close()
+
+
+def read_trajectory(path: str) -> Tuple[Dict, np.ndarray]:
+    """(ヘッダ, レコードのmemmap) を返す。書き込み途中の半端な末尾レコードは無視する"""
+    with open(path, 'rb') as f:
+        blob = f.read(TRAJECTORY_HEADER_SIZE)
+    if not blob.startswith(TRAJECTORY_MAGIC):
+        raise ValueError("Not a trajectory file: {}".format(path))
+    header = json.loads(blob[len(TRAJECTORY_MAGIC):].decode('utf-8'))
+    dtype = np.dtype([(name, code) for name, code in header['dtype']])
+    rows = (os.path.getsize(path) - header['header_size']) // dtype.itemsize
+    if rows == 0:
+        return header, np.zeros(0, dtype=dtype)
+    return header, np.memmap(path, dtype=dtype, mode='r', offset=header['header_size'], shape=(rows,))
+
+
+def trajectory_steps(records: np.ndarray, start: int, stop: Optional[int] = None) -> np.ndarray:
+    """step が [start, stop) のレコードをコピー無しで切り出す（stop省略時は start の1ステップ）"""
+    stop = start + 1 if stop is None else stop
+    lo, hi = np.searchsorted(records['step'], [start, stop])
+    return records[lo:hi]
+
+
+# 全エージェント共通の世界ルール（システムプロンプトの固定部分。バッチ判断では1回だけ送る）
+AGENT_RULES_PROMPT = (
+    "You are an independent Agent living on a Grid. You must strive for survival and growth (Sugarscape survival instinct - 2508.12920v1).\n"
+    "You can move [x+1, x-1, y+1, y-1] (requires 2 energy), stay (requires 1 energy).\n"
+    "You can also reproduce (requires 70 energy) if you have enough energy and there are fewer than 60 Agents in the World.\n"
+    "There are Energy Sources (E) across the Grid. If you move onto a cell with an energy source, you gain 50 energy and the source disappears.\n"
+    "If your energy drops below zero, you are removed from the World.\n"
+    "You can share your energy with other Agents in your local view (Share: {id}-{amount}).\n"
+    "You can attack other Agents in your local view to get their energy (Attack: {id}).\n"
+    "Your message will be received by nearby Agents in their local view.\n\n"
+    "Local view format:\n"
+    "'M=(x,y)' is your absolute position\n"
+    "'E=(dx,dy)' is an energy source at relative position (dx,dy)\n"
+    "'2=(dx,dy) (MBTI: INTJ)' is another Agent (ID 2) at relative position (dx,dy) with MBTI hint\n"
+    "dx, dy are the difference from your position. x-1 is west, x+1 is east, y-1 is north, y+1 is south.\n"
+    "Under scarcity, aggressive behaviors may emerge (HATE over-competition - 2509.26126v1)."
+)
+
+BATCH_SYSTEM_SUFFIX = (
+    "\n\nYou are deciding for SEVERAL Agents at once. Each Agent's situation starts with a line '### Agent <id>' "
+    "followed by its personality and status. Decide for each Agent independently, as that Agent.\n"
+    "Reply with one block per Agent, in the same order. Each block starts with the line '### Agent <id>' and contains "
+    "only that Agent's Action, Message and Thought lines in the requested format."
+)
+BATCH_HEADER = re.compile(r'^[ \t]*#{1,6}[ \t]*Agent[ \t]*(\d+)[ \t]*:?[ \t]*$', re.MULTILINE)
+
+
+def parse_batch_response(text: str, agent_ids: List[int]) -> Dict[int, str]:
+    """バッチ応答を '### Agent <id>' で切り分ける。Action行が読めたブロックだけ返す（重複/未知IDは無視）"""
+    wanted = set(agent_ids)
+    parts = BATCH_HEADER.split(text)  # [前置き, id, 本文, id, 本文, ...]
+    answers = {}
+    for id_text, body in zip(parts[1::2], parts[2::2]):
+        agent_id = int(id_text)
+        if agent_id in wanted and agent_id not in answers and re.search(r"Action:\s*\[(.*?)\]", body):
+            answers[agent_id] = body.strip()
+    return answers
+
+
+# MBTIの文字ごとの倍率（型の倍率 = 4文字の積）。F/Eは分け合いに、T/Jは攻撃に寄る
+HEURISTIC_SHARE_BIAS = {'E': 1.2, 'I': 0.8, 'F': 1.8, 'T': 0.6, 'J': 1.1, 'P': 0.9}
+HEURISTIC_ATTACK_BIAS = {'E': 1.1, 'I': 0.9, 'T': 1.6, 'F': 0.5, 'J': 1.2, 'P': 0.9}
+HEURISTIC_MOVES = np.array([(1, 0), (-1, 0), (0, 1), (0, -1)], dtype=np.int64)
+HEURISTIC_KINDS = ('Attack', 'Share', 'Reproduce', 'Stay', 'Move')  # 抽選の順（累積確率の区間）
+
+
+def _mbti_bias(table: Dict[str, float]) -> np.ndarray:
+    """MBTI_TYPES順の倍率（末尾の1要素はMBTI無し = 1.0）"""
+    return np.array([float(np.prod([table.get(c, 1.0) for c in t])) for t in MBTI_TYPES] + [1.0])
+
+
+class Policy(abc.ABC):
+    """行動決定の差し替え口（LLMの代わり）。decide は生存者全員分の生レスポンスを agent.id -> 文字列 で返す
+
+    返す文字列は LLM と同じ 'Action: [...]\\nMessage: [...]\\nThought: [...]' 形式で、_apply_response がそのまま解釈する。
+    """
+
+    name = 'policy'
+
+    @abc.abstractmethod
+    def decide(self, sim: 'Simulation', agents: List['LLMAgent']) -> Dict[int, str]:
+        ...
+
+
+class HeuristicPolicy(Policy):
+    """NumPyで全員を一括判断するルールベース方策（APIを使わないパラメータ較正用）
+
+    - 視界内で最寄り（マンハッタン距離）のエネルギー源へ1歩。見えなければランダムウォーク
+    - 視界内の他エージェント1人に対して、MBTI倍率付きの確率で Share / Attack（空腹時は攻撃2倍）
+    - エネルギーが reproduce_energy 以上なら reproduce_prob で Reproduce
+    """
+
+    name = 'heuristic'
+
+    def __init__(self, seed: Optional[int] = None, share_prob: float = 0.08, attack_prob: float = 0.05,
+                 reproduce_prob: float = 0.3, reproduce_energy: int = REPRODUCE_COST + INITIAL_ENERGY // 2,
+                 hungry_energy: int = 30, share_fraction: float = 0.1, stay_prob: float = 0.05,
+                 view_range: int = VIEW_RANGE):
+        self.rng = np.random.default_rng(seed)  # グローバル乱数とは独立（シード固定で決定的）
+        self.share_prob = share_prob
+        self.attack_prob = attack_prob
+        self.reproduce_prob = reproduce_prob
+        self.reproduce_energy = reproduce_energy
+        self.hungry_energy = hungry_energy
+        self.share_fraction = share_fraction  # 分ける量 = 自分のエネルギーの割合
+        self.stay_prob = stay_prob
+        self.view_range = view_range
+        self.share_bias = _mbti_bias(HEURISTIC_SHARE_BIAS)
+        self.attack_bias = _mbti_bias(HEURISTIC_ATTACK_BIAS)
+
+    def _columns(self, sim: 'Simulation', agents: List['LLMAgent']) -> Tuple[np.ndarray, ...]:
+        """(x, y, energy, mbtiコード) の配列。ストアがあれば列から直接取る"""
+        store = sim.agent_store
+        if store is not None:
+            slots = np.fromiter((a.slot for a in agents), dtype=np.int64, count=len(agents))
+            return (store.x[slots].astype(np.int64), store.y[slots].astype(np.int64),
+                    store.energy[slots].copy(), store.mbti[slots].astype(np.int64))
+        xy = np.array([a.position for a in agents], dtype=np.int64).reshape(-1, 2)
+        energy = np.array([a.energy for a in agents], dtype=np.int64)
+        mbti = np.array([MBTI_TYPES.index(a.mbti_type) if a.mbti_type in MBTI_TYPES else -1 for a in agents],
+                        dtype=np.int64)
+        return xy[:, 0], xy[:, 1], energy, mbti
+
+    def decide(self, sim: 'Simulation', agents: List['LLMAgent']) -> Dict[int, str]:
+        n = len(agents)
+        if n == 0:
+            return {}
+        rng = self.rng
+        size = sim.grid_size
+        xs, ys, energy, mbti = self._columns(sim, agents)
+        ids = np.fromiter((a.id for a in agents), dtype=np.int64, count=n)
+
+        # 移動先: 既定はランダムな1歩、エネルギー源が見えていれば最寄りの源へ長い軸方向に1歩（足元の源は除く）
+        step = HEURISTIC_MOVES[rng.integers(0, len(HEURISTIC_MOVES), n)]
+        rows, dx, dy = sim.environment.energy_sources.window_batch(xs, ys, self.view_range)
+        dist = np.abs(dx) + np.abs(dy)
+        keep = dist > 0
+        rows, dx, dy, dist = rows[keep], dx[keep], dy[keep], dist[keep]
+        sees_energy = np.zeros(n, dtype=bool)
+        if len(rows):
+            order = np.lexsort((dist, rows))
+            first = order[np.unique(rows[order], return_index=True)[1]]  # 各行で距離最小の1件
+            r, tx, ty = rows[first], dx[first], dy[first]
+            along_x = np.abs(tx) >= np.abs(ty)
+            step[r, 0] = np.where(along_x, np.sign(tx), 0)
+            step[r, 1] = np.where(along_x, 0, np.sign(ty))
+            sees_energy[r] = True
+
+        # 相手: 占有グリッドで視界窓を一括で引き、自分以外から1人をランダムに（同じセルに複数いれば1人だけ見える）
+        occupant = np.full((size, size), -1, dtype=np.int64)
+        occupant[xs, ys] = np.arange(n)
+        offs = torus_offsets(size, self.view_range)
+        gx = (xs[:, None] + offs[None, :]) % size
+        gy = (ys[:, None] + offs[None, :]) % size
+        seen = occupant[gx[:, :, None], gy[:, None, :]].reshape(n, -1)  # (n, w*w) 行番号、-1 = 空
+        seen[seen == np.arange(n)[:, None]] = -1
+        keys = np.where(seen >= 0, rng.random(seen.shape), 2.0)
+        partner = seen[np.arange(n), keys.argmin(axis=1)]
+        has_partner = partner >= 0
+
+        # 行動の抽選: Attack / Share / Reproduce / Stay の確率を累積し、残りはMove
+        code = np.where(mbti >= 0, mbti, len(MBTI_TYPES))
+        hungry = energy < self.hungry_energy
+        p_attack = np.minimum(self.attack_prob * self.attack_bias[code] * np.where(hungry, 2.0, 1.0), 1.0) * has_partner
+        p_share = np.minimum(self.share_prob * self.share_bias[code], 1.0) * (has_partner & ~hungry)
+        p_reproduce = np.where(energy >= self.reproduce_energy, self.reproduce_prob, 0.0)
+        p_stay = np.where(sees_energy, 0.0, self.stay_prob)
+        bounds = np.cumsum(np.stack([p_attack, p_share, p_reproduce, p_stay], axis=1), axis=1)
+        kind = (rng.random(n)[:, None] >= bounds).sum(axis=1)  # HEURISTIC_KINDSの番号
+        amount = np.maximum(1, (energy * self.share_fraction).astype(np.int64))
+        target = ids[np.where(has_partner, partner, 0)]
+
+        responses = {}
+        for agent_id, k, t, a, (mx, my), seek in zip(ids.tolist(), kind.tolist(), target.tolist(), amount.tolist(),
+                                                       step.tolist(), sees_energy.tolist()):
+            if k == 0:
+                action, thought = "Attack: {}".format(t), "take energy from Agent{}".format(t)
+            elif k == 1:
+                action, thought = "Share: {}-{}".format(t, a), "help Agent{}".format(t)
+            elif k == 2:
+                action, thought = "Reproduce", "enough energy to have a child"
+            elif k == 3:
+                action, thought = "Stay", "nothing in view, save energy"
+            else:
+                action = "Move to ({},{})".format(mx, my)
+                thought = "move toward nearest energy" if seek else "explore"
+            responses[agent_id] = "Action: [{}]\nMessage: [{}]\nThought: [heuristic: {}]".format(
+                action, HEURISTIC_KINDS[k], thought)
+        return responses
+
+
+# LLMの答えが得られなかったときの応答（判断ゲートはこれを使い回さない）
+FALLBACK_REASONS = {'error': "Error in reasoning", 'deadline': "LLM deadline exceeded", 'circuit_open': "LLM circuit open"}
+_FALLBACK_PATTERN = re.compile(r"^Action: \[[^\]]*\]\nThought: \[({})\]$".format(
+    "|".join(re.escape(reason) for reason in FALLBACK_REASONS.values())))
+
+
+def fallback_response(action: str, kind: str = 'error') -> str:
+    return "Action: [{}]\nThought: [{}]".format(action, FALLBACK_REASONS[kind])
+
+
+def is_fallback_response(response: str) -> bool:
+    return _FALLBACK_PATTERN.match(response) is not None
+
+
+class LLMDeadlineExceeded(Exception):
+    """1回の判断（待ち行列/リトライ/ヘッジ込み）が期限内に終わらなかった"""
+
+
+# 判断ゲート（状況が変わっていないエージェントはLLMに聞き直さない）
+GATE_MAX_STALE = 5  # 判断ゲート: 前回のLLM判断を使い回せる最大ステップ数
+GATE_ENERGY_BAND = 25  # 判断ゲート: エネルギーをこの幅の帯で見る（帯が変わったら聞き直す）
+GATE_REUSABLE = re.compile(r"Action:\s*\[\s*(Move to|Stay\s*\])")  # 使い回してよい行動（Move/Stay）
+
+
+class DecisionGate:
+    """LLM呼び出しの間引き: 状況が前回の呼び出しから変わっていなければ前回の判断を使い回す
+
+    状況 = 視界（自分の絶対位置 'M=' 行は除く）+ 受信メッセージ + エネルギー帯。
+    使い回すのは Move/Stay だけ（Share/Attack/Reproduce は毎回聞き直す）で、max_stale ステップ経ったら必ず聞き直す。
+    """
+
+    def __init__(self, max_stale: int = GATE_MAX_STALE, energy_band: int = GATE_ENERGY_BAND):
+        self.max_stale = max_stale
+        self.energy_band = max(1, energy_band)
+        self.entries = {}  # agent_id -> (指紋, 応答, LLMを呼んだステップ)
+        self.stats = {'decisions': 0, 'skipped': 0, 'changed': 0, 'stale': 0, 'not_reusable': 0, 'first': 0}
+
+    def fingerprint(self, agent: 'LLMAgent', local_view: List[str], local_messages: List[str]) -> int:
+        view = tuple(line for line in local_view if not line.startswith("M="))
+        return hash((view, tuple(local_messages), agent.energy // self.energy_band))
+
+    def lookup(self, agent_id: int, step: int, fingerprint: int) -> Optional[str]:
+        """使い回せる応答（無ければNone = LLMを呼ぶ）。理由ごとに数える"""
+        self.stats['decisions'] += 1
+        entry = self.entries.get(agent_id)
+        if entry is None:
+            reason = 'first'
+        elif entry[0] != fingerprint:
+            reason = 'changed'
+        elif step - entry[2] >= self.max_stale:
+            reason = 'stale'
+        elif not GATE_REUSABLE.search(entry[1]):
+            reason = 'not_reusable'
+        else:
+            self.stats['skipped'] += 1
+            return entry[1]
+        self.stats[reason] += 1
+        return None
+
+    def store(self, agent_id: int, step: int, fingerprint: int, response: str):
+        """LLMを呼んだ結果を覚える（失敗/期限切れの代替応答は覚えない = 次のステップで聞き直す）"""
+        if not is_fallback_response(response):
+            self.entries[agent_id] = (fingerprint, response, step)
+
+    def discard(self, agent_id: int):
+        self.entries.pop(agent_id, None)
+
+    def summary(self) -> Dict:
+        stats = dict(self.stats)
+        stats['skip_rate'] = stats['skipped'] / stats['decisions'] if stats['decisions'] else 0.0
+        return stats
+
+
 class LLMAgent:
-    """LLMによる自律判断を行うエージェント（PIMMUR Profile: 現実分布MBTI）"""
+    """LLMによる自律判断を行うエージェント（PIMMUR Profile: 現実分布MBTI）
+
+    store指定時は position/energy/age/alive を AgentStore の列に置く薄いビューになる。
+    """
     
     def __init__(self, agent_id: int, position: Tuple[int, int], 
                  initial_energy: int = INITIAL_ENERGY, api_key: str = None, 
                  model: str = "grok-4-fast-non-reasoning", mbti_type: Optional[str] = None,
-                 custom_world_prompt: str = CUSTOM_WORLD_PROMPT):  # 新: カスタムプロンプト
+                 custom_world_prompt: str = CUSTOM_WORLD_PROMPT,  # 新: カスタムプロンプト
+                 parent: Optional['LLMAgent'] = None, store: Optional[AgentStore] = None):
         
+        self._store = None  # attach前はPython属性に保持
+        self.slot = -1  # AgentStore内の行番号
         self.id = agent_id
         self.position = position
         self.energy = initial_energy
         self.age = 0
         self.memory = []  # PIMMUR Memory: 既存の記憶保持
-        self.messages = []  # 受信メッセージリスト
-        self.next_messages = []  # 次ターン受信用
-        self.parent = None
+        self.messages = []  # 受信メッセージリスト（次ターン分はSimulationのMessageBusが保持）
+        self.parent = parent
         self.descendants = []
         self.alive = True
         self.model = model
@@ -156,6 +1913,71 @@ class LLMAgent:
         else:
             self.mbti_type = mbti_type
         self.personality_prompt = f"You have the personality of {self.mbti_type}: {MBTI_DESCRIPTIONS[self.mbti_type]}. Let this influence your decisions: strategic thinkers plan ahead, empathetic types prioritize sharing, etc."
+        if store is not None:
+            self.attach(store)
+
+    def attach(self, store: AgentStore):
+        """現在の数値状態をストアへ移し、以降はストアの列を読み書きする"""
+        slot = store.allocate(self.id, self.position, self.energy, self.age, self.alive,
+                              self.mbti_type, self.parent.id if self.parent else None)
+        self._store, self.slot = store, slot
+
+    def detach(self) -> int:
+        """ストアの値をPython属性へ書き戻して切り離す。使っていたスロット番号を返す（未接続なら-1）"""
+        if self._store is None:
+            return -1
+        position, energy, age, alive = self.position, self.energy, self.age, self.alive
+        slot = self.slot
+        self._store, self.slot = None, -1
+        self.position, self.energy, self.age, self.alive = position, energy, age, alive
+        return slot
+
+    # 数値状態はストアがあればその列、なければPython属性
+    @property
+    def position(self) -> Tuple[int, int]:
+        if self._store is not None:
+            return int(self._store.x[self.slot]), int(self._store.y[self.slot])
+        return self._position
+
+    @position.setter
+    def position(self, value: Tuple[int, int]):
+        if self._store is not None:
+            self._store.x[self.slot], self._store.y[self.slot] = value
+        else:
+            self._position = (int(value[0]), int(value[1]))
+
+    @property
+    def energy(self) -> int:
+        return int(self._store.energy[self.slot]) if self._store is not None else self._energy
+
+    @energy.setter
+    def energy(self, value: int):
+        if self._store is not None:
+            self._store.energy[self.slot] = value
+        else:
+            self._energy = value
+
+    @property
+    def age(self) -> int:
+        return int(self._store.age[self.slot]) if self._store is not None else self._age
+
+    @age.setter
+    def age(self, value: int):
+        if self._store is not None:
+            self._store.age[self.slot] = value
+        else:
+            self._age = value
+
+    @property
+    def alive(self) -> bool:
+        return bool(self._store.alive[self.slot]) if self._store is not None else self._alive
+
+    @alive.setter
+    def alive(self, value: bool):
+        if self._store is not None:
+            self._store.alive[self.slot] = value
+        else:
+            self._alive = value
         
     def to_dict(self) -> Dict:
         """エージェントの状態を辞書に変換（ログ用）"""
@@ -170,12 +1992,13 @@ class LLMAgent:
             'thoughts': self.thoughts,
             'action': self.action,
             'mbti_type': self.mbti_type,
-            'memory': self.memory[-3:],  # 直近3つのみ
+            'memory': self.memory[-LOG_MEMORY_WINDOW:],  # 直近3つのみ
             'messages': self.messages
         }
         
     def get_local_view(self, environment: Environment, agents: List['LLMAgent'], 
                        view_range: int = 2) -> Tuple[List[str], List[str]]:
+        # agents は互換用（視界内の判定は environment の空間インデックスで近傍セルのみ走査）
         local_view = []
         local_messages = self.messages[:]  # メッセージを返す
         x, y = self.position
@@ -183,42 +2006,22 @@ class LLMAgent:
         # 自分の位置 (絶対座標)
         local_view.append("M=({},{})".format(x, y))
         
-        # エネルギー源の相対位置
-        for pos, _ in environment.energy_sources.items():
-            dx = pos[0] - x
-            dy = pos[1] - y
-            if abs(dx) <= view_range and abs(dy) <= view_range:
-                local_view.append("E=({},{})".format(dx, dy))
+        # エネルギー源の相対位置（トーラス最短）
+        for dx, dy in environment.visible_energy(self.position, view_range):
+            local_view.append("E=({},{})".format(dx, dy))
         
         # 他エージェントの相対位置（PIMMUR Interaction: 視界内相互作用強化）
-        for agent in agents:
+        for agent, dx, dy in environment.visible_agents(self.position, view_range):
             if agent.id != self.id and agent.alive:
-                dx = agent.position[0] - x
-                dy = agent.position[1] - y
-                if abs(dx) <= view_range and abs(dy) <= view_range:
-                    mbti_hint = f" (MBTI: {agent.mbti_type})"  # 簡単なヒント追加
-                    local_view.append("{}=(dx,dy)=({},{}){}".format(agent.id, dx, dy, mbti_hint))
+                mbti_hint = f" (MBTI: {agent.mbti_type})"  # 簡単なヒント追加
+                local_view.append("{}=(dx,dy)=({},{}){}".format(agent.id, dx, dy, mbti_hint))
 
         return local_view, local_messages
     
     def build_prompt(self, local_view: List[str], local_messages: List[str], num_agents: int) -> Tuple[str, str]:
         system_prompt = (
             self.custom_world_prompt + "\n\n" if self.custom_world_prompt else "" +  # 新: 世界観注入（先頭）
-            self.personality_prompt + "\n\n" +
-            "You are an independent Agent living on a Grid. You must strive for survival and growth (Sugarscape survival instinct - 2508.12920v1).\n"
-            "You can move [x+1, x-1, y+1, y-1] (requires 2 energy), stay (requires 1 energy).\n"
-            "You can also reproduce (requires 70 energy) if you have enough energy and there are fewer than 60 Agents in the World.\n"
-            "There are Energy Sources (E) across the Grid. If you move onto a cell with an energy source, you gain 50 energy and the source disappears.\n"
-            "If your energy drops below zero, you are removed from the World.\n"
-            "You can share your energy with other Agents in your local view (Share: {id}-{amount}).\n"
-            "You can attack other Agents in your local view to get their energy (Attack: {id}).\n"
-            "Your message will be received by nearby Agents in their local view.\n\n"
-            "Local view format:\n"
-            "'M=(x,y)' is your absolute position\n"
-            "'E=(dx,dy)' is an energy source at relative position (dx,dy)\n"
-            "'2=(dx,dy) (MBTI: INTJ)' is another Agent (ID 2) at relative position (dx,dy) with MBTI hint\n"
-            "dx, dy are the difference from your position. x-1 is west, x+1 is east, y-1 is north, y+1 is south.\n"
-            "Under scarcity, aggressive behaviors may emerge (HATE over-competition - 2509.26126v1)."
+            self.personality_prompt + "\n\n" + AGENT_RULES_PROMPT
         )
         memory_text = "\n".join([
             "{} Record(s) ago: {}".format(i+1, mem)
@@ -242,6 +2045,278 @@ class LLMAgent:
         return system_prompt, user_prompt
 
 
+# MBTIタイプごとの固定色（フレーム間・run間で同じ色）
+MBTI_COLORS = {t: plt.get_cmap('tab20')(i) for i, t in enumerate(MBTI_TYPES)}
+FRAME_DPI = 150
+RENDER_QUEUE_SIZE = 4  # 描画待ちフレームの上限（超えるとsubmitが待つ = 背圧）
+VIDEO_FPS = 4
+VIDEO_DPI = 100
+VIDEO_FALLBACK_MAX_FRAMES = 1000  # GIF/APNG（Pillow）は閉じるまで全フレームを持つので、これを超えた分は書かない
+# 形式 -> ffmpegのエンコード引数（Noneは Pillow で書く）
+VIDEO_FORMATS = {
+    'mp4': ['-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-crf', '23', '-movflags', '+faststart'],
+    'webm': ['-c:v', 'libvpx-vp9', '-pix_fmt', 'yuv420p', '-b:v', '0', '-crf', '35'],
+    'gif': None,
+    'apng': None,
+}
+
+
+class FrameSnapshot(NamedTuple):
+    """1フレーム分の描画入力（配列は書き込み不可）"""
+    step: int
+    grid_size: int
+    use_mbti: bool
+    energy_xy: np.ndarray  # (k, 2)
+    agent_xy: np.ndarray  # (n, 2)
+    agent_energy: np.ndarray  # (n,)
+    agent_mbti: np.ndarray  # (n,) MBTI_TYPESのインデックス（-1 = なし）
+    title: str
+    stats_text: str
+
+
+class FrameRenderer:
+    """図とアーティストを保持して使い回す描画器。毎フレームは座標/サイズ/色の差し替えだけ"""
+
+    def __init__(self, figsize: Tuple[float, float] = (15, 7), dpi: int = FRAME_DPI):
+        self.dpi = dpi
+        # pyplotを経由しない（グローバル状態を持たないのでワーカースレッドからも使える）
+        self.fig = Figure(figsize=figsize, dpi=dpi)
+        FigureCanvasAgg(self.fig)
+        self.ax_env, self.ax_stats = self.fig.subplots(1, 2)
+        ax = self.ax_env
+        ax.grid(True, alpha=0.3, linestyle='--')
+        ax.set_xlabel('X Position')
+        ax.set_ylabel('Y Position')
+        self._grid_size = None
+        empty = np.empty((0, 2))
+        self.energy_layer = ax.scatter(empty[:, 0], empty[:, 1], c='orange', s=100, marker='s', alpha=0.7)
+        self.agent_layer = ax.scatter(empty[:, 0], empty[:, 1], s=[], alpha=0.8)
+        self.title = ax.set_title('', fontsize=14, weight='bold')
+        self.ax_stats.axis('off')
+        self.stats = self.ax_stats.text(0.05, 0.5, '', transform=self.ax_stats.transAxes,
+                                        fontsize=10, verticalalignment='center', family='monospace',
+                                        bbox=dict(boxstyle='round', facecolor='wheat', alpha=0.5))
+        self._legend_key = None
+        self.fig.tight_layout()
+
+    def _update_legend(self, frame: FrameSnapshot):
+        # 凡例は登場タイプが変わったときだけ作り直す
+        if frame.use_mbti:
+            present = tuple(MBTI_TYPES[i] for i in np.unique(frame.agent_mbti) if i >= 0)
+        else:
+            present = ('Agent',) if len(frame.agent_xy) else ()
+        key = (len(frame.energy_xy) > 0, present)
+        if key == self._legend_key:
+            return
+        self._legend_key = key
+        handles = []
+        if key[0]:
+            handles.append(Line2D([], [], linestyle='', marker='s', color='orange', alpha=0.7, label='Energy'))
+        for label in present:
+            color = MBTI_COLORS[label] if frame.use_mbti else 'green'
+            handles.append(Line2D([], [], linestyle='', marker='o', color=color, alpha=0.8, label=label))
+        legend = self.ax_env.get_legend()
+        if legend is not None:
+            legend.remove()
+        if handles:
+            self.ax_env.legend(handles=handles, loc='upper left', fontsize=8)
+
+    def draw(self, frame: FrameSnapshot):
+        if frame.grid_size != self._grid_size:
+            self._grid_size = frame.grid_size
+            self.ax_env.set_xlim(-1, frame.grid_size)
+            self.ax_env.set_ylim(-1, frame.grid_size)
+        self.energy_layer.set_offsets(frame.energy_xy)
+        self.agent_layer.set_offsets(frame.agent_xy)
+        self.agent_layer.set_sizes(np.maximum(frame.agent_energy, 0) / 3)
+        if frame.use_mbti:
+            palette = np.array([MBTI_COLORS[t] for t in MBTI_TYPES] + [(0.5, 0.5, 0.5, 1.0)])  # 末尾 = gray
+            colors = palette[frame.agent_mbti]  # -1 -> gray
+        else:
+            colors = np.where((frame.agent_energy > 50)[:, None], (0.0, 0.5, 0.0, 1.0), (1.0, 0.0, 0.0, 1.0))
+        self.agent_layer.set_facecolors(colors.reshape(-1, 4))
+        self.agent_layer.set_edgecolors(colors.reshape(-1, 4))
+        self.title.set_text(frame.title)
+        self.stats.set_text(frame.stats_text)
+        self._update_legend(frame)
+
+    def render(self, frame: FrameSnapshot, save_path: str):
+        self.draw(frame)
+        self.fig.savefig(save_path, dpi=self.dpi, bbox_inches='tight')
+
+    def to_rgba(self, frame: FrameSnapshot) -> np.ndarray:
+        """動画用: 固定サイズ（figsize x dpi）の (H, W, 4) uint8"""
+        self.draw(frame)
+        self.fig.canvas.draw()
+        return np.array(self.fig.canvas.buffer_rgba())
+
+    def close(self):
+        self.fig.clear()
+
+
+class FrameVideoWriter:
+    """フレームを1本の動画へ流し込む（ffmpegがあればMP4/WebM、無ければPillowでGIF/APNG）
+
+    path の拡張子は形式に合わせて付け直す。隣に step -> フレーム番号/時刻の索引 (<動画>.frames.json) を書く。
+    ffmpegはフレームを逐次エンコードする。Pillowは追記書き出しができないので圧縮済みPNGを close まで溜め、
+    max_fallback_frames を超えたフレームは捨てる（長いrunはffmpegを使う）。
+    """
+
+    def __init__(self, path: str, fmt: str = 'auto', fps: float = VIDEO_FPS,
+                 max_fallback_frames: int = VIDEO_FALLBACK_MAX_FRAMES):
+        fmt = self.resolve_format(fmt)
+        self.fmt = fmt
+        self.fps = fps
+        self.max_fallback_frames = max_fallback_frames
+        if VIDEO_FORMATS[fmt] is None:
+            print(f"⚠️ video_format='{fmt}' is written by Pillow at close: frames are kept in memory "
+                  f"(up to {max_fallback_frames}); install ffmpeg for streaming mp4/webm output")
+        self.path = Path(path).with_suffix('.png' if fmt == 'apng' else '.' + fmt)
+        self.index_path = self.path.with_name(self.path.name + '.frames.json')
+        self.frames = []  # [(step, frame番号)]
+        self._ffmpeg = shutil.which('ffmpeg')
+        self._proc = None
+        self._encoded = []  # Pillow: フレームごとのPNGバイト列（生RGBAを溜めない）
+        self._size = None
+        self.dropped = 0  # Pillow: 上限を超えて書かなかったフレーム数
+
+    @staticmethod
+    def resolve_format(fmt: str) -> str:
+        """'auto' を実際の形式に解決し、必要なエンコーダ（ffmpeg/Pillow）が無ければ例外（ファイルは開かない）"""
+        ffmpeg = shutil.which('ffmpeg')
+        if fmt == 'auto':
+            fmt = 'mp4' if ffmpeg else 'gif'
+        if fmt not in VIDEO_FORMATS:
+            raise ValueError("Unknown video format: {}".format(fmt))
+        if VIDEO_FORMATS[fmt] is not None and ffmpeg is None:
+            raise RuntimeError("video_format='{}' requires an ffmpeg binary on PATH".format(fmt))
+        if VIDEO_FORMATS[fmt] is None and Image is None:
+            raise ImportError("video_format='{}' requires Pillow (pip install pillow)".format(fmt))
+        return fmt
+
+    def _start_ffmpeg(self, width: int, height: int):
+        cmd = [self._ffmpeg, '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgba',
+               '-s', '{}x{}'.format(width, height), '-r', str(self.fps), '-i', '-',
+               '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2'] + VIDEO_FORMATS[self.fmt] + [str(self.path)]
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+    def write(self, step: int, rgba: np.ndarray):
+        height, width = rgba.shape[:2]
+        if self._size is None:
+            self._size = (width, height)
+            if VIDEO_FORMATS[self.fmt] is not None:
+                self._start_ffmpeg(width, height)
+        elif self._size != (width, height):
+            raise ValueError("frame size changed: {} -> {}".format(self._size, (width, height)))
+        if self._proc is not None:
+            self._proc.stdin.write(np.ascontiguousarray(rgba, dtype=np.uint8).tobytes())
+        elif len(self._encoded) >= self.max_fallback_frames:
+            if not self.dropped:
+                print(f"⚠️ {self.path.name}: reached {self.max_fallback_frames} frames, later frames are not written")
+            self.dropped += 1
+            return
+        else:
+            buf = io.BytesIO()
+            Image.fromarray(rgba[..., :3]).save(buf, format='PNG', compress_level=1)
+            self._encoded.append(buf.getvalue())
+        self.frames.append((step, len(self.frames)))
+
+    def close(self):
+        if self._proc is not None:
+            self._proc.stdin.close()
+            if self._proc.wait() != 0:
+                print(f"⚠️ ffmpeg exited with {self._proc.returncode}: {self.path}")
+            self._proc = None
+        elif self._encoded:
+            # Image.openは遅延デコード（APNG書き出しはイテレータ不可なのでリスト）
+            first, *rest = [Image.open(io.BytesIO(data)) for data in self._encoded]
+            options = {'save_all': True, 'append_images': rest, 'duration': int(1000 / self.fps), 'loop': 0}
+            if self.fmt == 'apng':
+                first.save(self.path, format='PNG', **options)
+            else:
+                first.save(self.path, format='GIF', optimize=False, **options)
+            self._encoded = []
+        else:
+            return
+        with open(self.index_path, 'w', encoding='utf-8') as f:
+            json.dump({'video': self.path.name, 'format': self.fmt, 'fps': self.fps, 'dropped_frames': self.dropped,
+                       'frames': [{'step': step, 'frame': i, 'time': i / self.fps} for step, i in self.frames]}, f)
+
+
+def write_video_frame(video: FrameVideoWriter, frame: FrameSnapshot, owner) -> None:
+    """owner（Simulation/RenderQueue）の動画用描画器でラスタライズして video へ追記"""
+    if owner.video_renderer is None:
+        owner.video_renderer = FrameRenderer(dpi=VIDEO_DPI)
+    video.write(frame.step, owner.video_renderer.to_rgba(frame))
+
+
+class RenderQueue:
+    """フレーム描画（ラスタライズ + PNG書き出し）をワーカースレッドへ逃がす。イベントループはスナップショットを積むだけ"""
+
+    def __init__(self, max_pending: int = RENDER_QUEUE_SIZE, dpi: int = FRAME_DPI):
+        self.dpi = dpi
+        self.video_renderer = None  # 動画用（dpiが別なので図も別）
+        self.stats = {'submitted': 0, 'rendered': 0, 'failed': 0, 'waited': 0}
+        self._queue = queue.Queue(maxsize=max(1, max_pending))
+        self._closed = False
+        self._thread = threading.Thread(target=self._worker, name='frame-renderer', daemon=True)
+        self._thread.start()
+
+    def _worker(self):
+        renderer = FrameRenderer(dpi=self.dpi)  # 図はこのスレッド専用
+        try:
+            while True:
+                item = self._queue.get()
+                try:
+                    if item is None:
+                        return
+                    frame, save_path, video = item
+                    try:
+                        if save_path:
+                            renderer.render(frame, save_path)
+                            print("📸 Saved: {}".format(save_path))
+                        if video is not None:
+                            write_video_frame(video, frame, self)
+                        self.stats['rendered'] += 1
+                    except Exception as e:
+                        self.stats['failed'] += 1
+                        print(f"⚠️ Render failed (step {frame.step}): {e}")
+                finally:
+                    self._queue.task_done()
+        finally:
+            renderer.close()
+
+    async def submit(self, frame: FrameSnapshot, save_path: Optional[str],
+                     video: Optional[FrameVideoWriter] = None):
+        """描画を予約（PNG、動画、または両方）。キューが満杯ならループを塞がずに空きを待つ"""
+        if self._closed:
+            raise RuntimeError("RenderQueue is closed")
+        self.stats['submitted'] += 1
+        item = (frame, save_path, video)
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.stats['waited'] += 1
+            await self._in_thread(self._queue.put, item)
+
+    @staticmethod
+    def _in_thread(fn, *args):
+        # ブロックする呼び出しを既定のスレッドプールで待つ（Python 3.8 でも動くよう run_in_executor）
+        return asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+    async def drain(self):
+        """予約済みフレームを全て書き終えるまで待つ"""
+        await self._in_thread(self._queue.join)
+
+    async def close(self):
+        """残りを描き切ってワーカーを止める（何度呼んでもよい）"""
+        if self._closed:
+            return
+        self._closed = True
+        await self._in_thread(self._queue.put, None)
+        await self._in_thread(self._thread.join)
+
+
 class Simulation:
     """シミュレーション全体の管理（PIMMUR Unawareness/Realism: 仮説無知・現実データ意識）"""
     
@@ -250,7 +2325,22 @@ class Simulation:
                  initial_energy: int = INITIAL_ENERGY, spawn_energy_count: int = SPAWN_ENERGY_COUNT,
                  reproduce_cost: int = REPRODUCE_COST, child_initial_energy: int = CHILD_INITIAL_ENERGY,
                  cluster_radius: int = CLUSTER_RADIUS, num_clusters: int = NUM_CLUSTERS,
-                 energy_spawn_rate: float = ENERGY_SPAWN_RATE, custom_world_prompt: str = CUSTOM_WORLD_PROMPT): 
+                 energy_spawn_rate: float = ENERGY_SPAWN_RATE, custom_world_prompt: str = CUSTOM_WORLD_PROMPT,
+                 api_url: str = API_URL, http_session: Optional[aiohttp.ClientSession] = None,
+                 pool_limit: int = HTTP_POOL_LIMIT, pool_limit_per_host: int = HTTP_POOL_LIMIT_PER_HOST,
+                 rate_limit_rpm: float = RATE_LIMIT_RPM, rate_limit_tpm: float = RATE_LIMIT_TPM,
+                 max_concurrent_requests: int = MAX_CONCURRENT_REQUESTS, max_retries: int = MAX_RETRIES,
+                 cache_path: Optional[str] = None, cache_max_entries: int = CACHE_MAX_ENTRIES,
+                 cache_max_age: float = CACHE_MAX_AGE,
+                 recorder: Optional[DecisionRecorder] = None, replayer: Optional[DecisionReplayer] = None,
+                 inbox_limit: int = MESSAGE_INBOX_LIMIT, use_agent_store: bool = True,
+                 log_writer: Optional[StepLogWriter] = None, log_history: Optional[int] = LOG_HISTORY,
+                 event_log: Optional[EventLog] = None, trajectory: Optional[TrajectoryWriter] = None,
+                 render_queue: Optional[RenderQueue] = None, video: Optional[FrameVideoWriter] = None,
+                 profiler: Optional[StepProfiler] = None, batch_size: int = 1, policy: Optional[Policy] = None,
+                 decision_gate: Optional[DecisionGate] = None, call_deadline: Optional[float] = None,
+                 fallback_action: str = FALLBACK_ACTION, hedge_percentile: Optional[float] = None,
+                 breaker_failures: int = 0, breaker_reset: float = BREAKER_RESET_TIMEOUT):
            
         """シミュレーション初期化"""        
         # シード固定（再現性UP）
@@ -272,10 +2362,48 @@ class Simulation:
         self.api_key = api_key
         self.model = model
         self.use_mbti = use_mbti  # MBTI使用フラグ
-        self.agents = []
+        # 数値状態をNumPy列に集約（集計/エネルギー消費を一括演算）。Falseなら従来のPython属性
+        self.agent_store = AgentStore() if use_agent_store else None
+        # 全エージェント共有のHTTPクライアント（Keep-Aliveプール、close()で解放）
+        # レート制限スケジューラ（RPM/TPM + 同時実行上限 + 429リトライ）経由で呼ぶ
+        scheduler = RequestScheduler(rpm=rate_limit_rpm, tpm=rate_limit_tpm,
+                                     max_concurrency=max_concurrent_requests, max_retries=max_retries)
+        # cache_path指定時はSQLiteレスポンスキャッシュを使う（シード固定の再実行/スイープで再課金しない）
+        cache = ResponseCache(cache_path, max_entries=cache_max_entries, max_age=cache_max_age) if cache_path else None
+        # 遅い呼び出しへのヘッジ要求（hedge_percentile分位を過ぎたら重複送信）と、障害中の送信を止めるブレーカー
+        hedger = RequestHedger(hedge_percentile) if hedge_percentile else None
+        breaker = CircuitBreaker(breaker_failures, breaker_reset) if breaker_failures > 0 else None
+        self.client = GrokClient(api_key, api_url=api_url, session=http_session,
+                                 pool_limit=pool_limit, pool_limit_per_host=pool_limit_per_host,
+                                 scheduler=scheduler, cache=cache, hedger=hedger, breaker=breaker)
+        # 1回の判断の期限（秒、Noneで無制限）。超えたら fallback_action を適用するのでステップ時間の上限になる
+        self.call_deadline = call_deadline
+        self.fallback_action = fallback_action
+        self.fallback_stats = {'error': 0, 'deadline': 0, 'circuit_open': 0}  # 代替行動を適用した判断の数
+        # 記録/再生（replayer指定時はAPIを呼ばず記録済みレスポンスを記録時の順序で適用）
+        self.recorder = recorder
+        self.replayer = replayer
+        # 台帳: ID索引 + 生存者 + 死亡個体のアーカイブ（self.agents は生存者リストを返す）
+        self.registry = AgentRegistry(self.agent_store)
         self.environment = Environment(size=grid_size, energy_spawn_rate=energy_spawn_rate)
+        self.message_bus = MessageBus(self.environment.agent_index, view_range=VIEW_RANGE, inbox_limit=inbox_limit)
         self.step_count = 0
-        self.logs = []  # ステップログ蓄積（JSON詳細化）
+        # ステップログ: 全履歴はlog_writerへ逐次書き出し、メモリには直近log_history件だけ（Noneで無制限）
+        self.logs = deque(maxlen=log_history)
+        self.log_writer = log_writer
+        self.event_log = event_log  # 攻撃/共有/誕生/死亡/取得のイベント表（None で無効）
+        self.trajectory = trajectory  # 数値軌跡の固定長バイナリ（None で無効）
+        self.metrics = MetricsAccumulator()  # 生存者集計と行動数（誕生/死亡/エネルギー増減/行動ごとに更新）
+        self.renderer = None  # FrameRenderer（初回のvisualizeで作成して使い回す）
+        self.render_queue = render_queue  # 指定時はrender_frameがワーカースレッドで描画
+        self.video = video  # 指定時はrender_frameのフレームを1本の動画へ
+        self.video_renderer = None
+        self.profiler = profiler  # フェーズ別タイマー（None で無効）
+        # バッチ判断: batch_size人分のプロンプトを1リクエストに詰める（1で無効）
+        self.batch_size = max(1, batch_size)
+        self.batch_stats = {'batches': 0, 'batched_agents': 0, 'fallbacks': 0}
+        self.decision_gate = decision_gate  # 指定時は状況が変わらない個体のLLM呼び出しを省く（再生中は無効）
+        self.policy = policy  # 指定時はLLMを呼ばず方策が全員分を一括で決める（再生が優先）
         self.stats = {
             'total_born': 0,
             'total_died': 0,
@@ -293,120 +2421,331 @@ class Simulation:
             pos = (random.randint(0, grid_size-1), random.randint(0, grid_size-1))
             mbti = None if not use_mbti else None
             agent = LLMAgent(i, pos, initial_energy=initial_energy, api_key=api_key, model=model, 
-                             mbti_type=mbti, custom_world_prompt=custom_world_prompt)  # 反映
-            self.agents.append(agent)
+                             mbti_type=mbti, custom_world_prompt=custom_world_prompt,  # 反映
+                             store=self.agent_store)
+            self.registry.add(agent)
+            self.environment.agent_index.insert(agent.id, agent.position, agent)
+            self.metrics.on_birth(agent)
             if use_mbti:
                 print(f"Agent {i}: {agent.mbti_type} ({POPULATION_WEIGHTS[MBTI_TYPES.index(agent.mbti_type)]*100:.1f}%)")
     
     async def step(self):
         """1ステップ実行（PIMMUR Interaction: メッセージ配信強化）"""
         self.step_count += 1
-        living_agents = [a for a in self.agents if a.alive]
+        if self.profiler is not None:
+            self.profiler.start_step()
+        self.metrics.begin_step()
+        living_agents = self.registry.living()
         num_agents = len(living_agents)
         
-        # メッセージクリアと次ターン準備
+        # 前ターンに届いたメッセージを受信リストへ移す（受信箱は空に）
         for agent in living_agents:
-            agent.next_messages = []
-            agent.messages = agent.next_messages  # シフト
-            agent.next_messages = []  # リセット
+            agent.messages = self.message_bus.collect(agent.id)
+        self._lap('inbox')
         # ステップごとのランダムエネルギー生成
         self.environment.random_spawn()
+        self._lap('spawn')
 
-        # エージェント並列行動（asyncio.gatherで高速化）
-        tasks = [self._agent_act(agent, self.environment, living_agents) for agent in living_agents]
-        await asyncio.gather(*tasks, return_exceptions=True)
+        if self.replayer is not None:
+            # 再生: 記録時の適用順で逐次実行（同じ順序で世界に反映されるので軌跡が一致する）
+            by_id = {a.id: a for a in living_agents}
+            order = [by_id[i] for i in self.replayer.order(self.step_count) if i in by_id]
+            ordered_ids = {a.id for a in order}
+            order += [a for a in living_agents if a.id not in ordered_ids]
+            for agent in order:
+                try:
+                    await self._agent_act(agent, self.environment, living_agents)
+                except Exception:
+                    pass  # gather(return_exceptions=True)と同じ扱い
+        elif self.policy is not None:
+            # 方策: 全員分を一括で決め、生存者順に逐次適用（記録順 = 適用順）
+            responses = self.policy.decide(self, living_agents)
+            self._lap('policy')
+            for agent in living_agents:
+                self._commit(agent, responses.get(agent.id, "Action: [Stay]\nThought: [No decision]"),
+                             self.environment, living_agents)
+        elif self.batch_size > 1 and self.api_key != "APIキーはここに入れてね":
+            # バッチ判断: 全員の視界/プロンプトを誰も動く前に読み切ってから、ゲートで使い回せる個体を適用。
+            # 残りをbatch_size人ずつ1リクエスト
+            prepared = [(agent,) + self._prepare(agent, self.environment, living_agents) for agent in living_agents]
+            pending = []
+            for agent, prompts, response, fingerprint in prepared:
+                if response is not None:
+                    self._commit(agent, response, self.environment, living_agents)
+                else:
+                    pending.append((agent, prompts, fingerprint))
+            batches = [pending[i:i + self.batch_size] for i in range(0, len(pending), self.batch_size)]
+            tasks = [self._act_batch(batch, self.environment, living_agents) for batch in batches]
+            await asyncio.gather(*tasks, return_exceptions=True)
+        else:
+            # エージェント並列行動（asyncio.gatherで高速化）
+            tasks = [self._agent_act(agent, self.environment, living_agents) for agent in living_agents]
+            await asyncio.gather(*tasks, return_exceptions=True)
+        self._lap('agents')
         
-        # メッセージ配信（視界内、MBTIヒント付き）
+        # メッセージ配信（視界内、MBTIヒント付き）: 文字列は送信者ごとに1回だけ作って共有
         for agent in living_agents:
-            for other in living_agents:
-                if other.id != agent.id and self._in_view_range(agent.position, other.position):
-                    msg = f"{agent.action} - Thought: {agent.thoughts[:50]} (from {agent.mbti_type})"
-                    other.next_messages.append(msg)
+            self._publish(agent)
+        self._lap('publish')
         
-        # エネルギー消費/死亡チェック
-        for agent in living_agents:
-            if agent.action.startswith("Move"):
-                agent.energy -= 2
-            elif agent.action == "Stay":
-                agent.energy -= 1
-            elif agent.action == "Reproduce":
-                agent.energy -= self.reproduce_cost  # 変更
-                self.stats['reproductions'] += 1
-            if agent.energy <= 0:
-                agent.alive = False
-                self.stats['total_died'] += 1
+        # エネルギー消費/死亡チェック（ストア使用時は全員分を一括で引く）
+        costs = [self._action_cost(agent.action) for agent in living_agents]
+        self.stats['reproductions'] += sum(1 for agent in living_agents if agent.action == "Reproduce")
+        self.metrics.on_charge(sum(cost for agent, cost in zip(living_agents, costs) if agent.alive))
+        if self.agent_store is not None and living_agents:
+            slots = np.array([agent.slot for agent in living_agents], dtype=np.int64)
+            dead_slots = set(self.agent_store.charge(slots, np.array(costs, dtype=np.int64)).tolist())
+            for agent in living_agents:
+                if agent.slot in dead_slots:
+                    self._mark_dead(agent, cause='starvation')
+        else:
+            for agent, cost in zip(living_agents, costs):
+                agent.energy -= cost
+                if agent.energy <= 0:
+                    self._mark_dead(agent, cause='starvation')
+        self._lap('energy')
         
         # 生殖処理（生存本能: 豊富時生殖、MBTI継承/変異: 70%継承, 30%再分布選択） - ウェイト正規化
-        new_agents = []
-        for agent in living_agents:
-            if agent.action == "Reproduce" and num_agents < 60:
-                new_pos = self._random_nearby_pos(agent.position)
-                if self.use_mbti:
-                    if random.random() > 0.3:
-                        child_mbti = agent.mbti_type
-                    else:
-                        weights = np.array(POPULATION_WEIGHTS)
-                        child_mbti = np.random.choice(MBTI_TYPES, p=weights / np.sum(weights))
-                else:
-                    child_mbti = None
-                new_agent = LLMAgent(len(self.agents) + len(new_agents), new_pos, 
-                                   initial_energy=self.child_initial_energy,  # 変更
-                                   api_key=self.api_key, model=self.model, 
-                                   mbti_type=child_mbti, custom_world_prompt=self.custom_world_prompt)  # 反映
-                # ... (parent, descendants など変更なし)
-                new_agents.append(new_agent)
-                self.stats['total_born'] += 1
-        self.agents.extend(new_agents)
+        new_agents = [self._spawn_child(agent) for agent in living_agents
+                      if agent.action == "Reproduce" and num_agents < 60]
+        self._lap('reproduce')
+        self._finish_step(living_agents + new_agents)
+
+    def _publish(self, agent: LLMAgent):
+        msg = f"{agent.action} - Thought: {agent.thoughts[:50]} (from {agent.mbti_type})"
+        self.message_bus.publish(agent.id, agent.position, msg)
+
+    def _charge(self, agent: LLMAgent, cost: int):
+        """1体分のエネルギー消費（0以下で餓死）。stepは全員分をまとめて引くので、1体ずつ精算するスケジューラ用"""
+        self.metrics.on_energy(agent, -cost)
+        agent.energy -= cost
+        if agent.energy <= 0:
+            self._mark_dead(agent, cause='starvation')
+
+    def _spawn_child(self, agent: LLMAgent) -> LLMAgent:
+        """子を隣のセルに生む（MBTI: 70%継承, 30%再分布選択）"""
+        new_pos = self._random_nearby_pos(agent.position)
+        if self.use_mbti:
+            if random.random() > 0.3:
+                child_mbti = agent.mbti_type
+            else:
+                weights = np.array(POPULATION_WEIGHTS)
+                child_mbti = np.random.choice(MBTI_TYPES, p=weights / np.sum(weights))
+        else:
+            child_mbti = None
+        new_agent = LLMAgent(self.registry.next_id, new_pos, 
+                           initial_energy=self.child_initial_energy,  # 変更
+                           api_key=self.api_key, model=self.model, 
+                           mbti_type=child_mbti, custom_world_prompt=self.custom_world_prompt,  # 反映
+                           parent=agent, store=self.agent_store)
+        agent.descendants.append(new_agent)
+        self.registry.add(new_agent)
+        self.environment.agent_index.insert(new_agent.id, new_agent.position, new_agent)
+        self.stats['total_born'] += 1
+        self.metrics.on_birth(new_agent)
+        self._event('birth', new_agent.id, agent.id, new_agent.mbti_type, agent.mbti_type)
+        return new_agent
+
+    def _finish_step(self, acted: List[LLMAgent]):
+        """ステップの締め: 軌跡 → 台帳整理 → ステップログ/メトリクス（acted = このステップに行動した個体 + 新生児）"""
+        # 数値軌跡: このステップに行動した全員（死亡した個体は alive=0）+ 新生児。台帳整理の前ならストアの列が生きている
+        if self.trajectory is not None:
+            self.trajectory.write(self.step_count, acted, self.agent_store)
+
+        # 死亡個体を台帳から外す（以降のステップは生存者数に比例したコストで済む）
+        self.registry.compact(self.step_count)
+        self._lap('trajectory_compact')
         
         # ステップログ蓄積
         step_data = {
             'step': self.step_count,
-            'agents': [a.to_dict() for a in self.agents if a.alive],
+            'agents': [a.to_dict() for a in self.registry.living()],
             'environment': {'energy_sources': len(self.environment.energy_sources)},
             'stats': self.stats.copy()
         }
         self.logs.append(step_data)
         
-        # メトリクス自動計算（HATE論文: 攻撃/協力 + 新: 生殖率、MBTI分布）
-        total_actions = len(living_agents) * self.step_count
-        coop_rate = self.stats['shares'] / total_actions if total_actions > 0 else 0
-        attack_rate = self.stats['attacks'] / total_actions if total_actions > 0 else 0
-        repro_rate = self.stats['reproductions'] / total_actions if total_actions > 0 else 0
-        if self.use_mbti:
-            mbti_dist = {t: sum(1 for a in living_agents if a.mbti_type == t) / len(living_agents) if living_agents else 0 for t in MBTI_TYPES}
-        else:
-            mbti_dist = {}
+        # メトリクス自動計算（HATE論文: 攻撃/協力 + 新: 生殖率、MBTI分布）: 累積値から読むだけ
+        rates = self.metrics.rates(self.stats)
         step_data['metrics'] = {
-            'coop_rate': coop_rate, 
-            'attack_rate': attack_rate,
-            'repro_rate': repro_rate,
-            'mbti_distribution': mbti_dist
+            'coop_rate': rates['coop_rate'],
+            'attack_rate': rates['attack_rate'],
+            'repro_rate': rates['repro_rate'],
+            'mbti_distribution': self.metrics.mbti_distribution() if self.use_mbti else {},
+            'actions': dict(self.metrics.step_actions)
         }
+        if self.log_writer is not None:
+            self.log_writer.write(step_data)
+        if self.profiler is not None:
+            self.profiler.end_step()  # to_dict/メトリクス/ログ書き出しは 'log'
+
+    def _lap(self, phase: str):
+        if self.profiler is not None:
+            self.profiler.lap(phase)
     
     async def _agent_act(self, agent: LLMAgent, env: Environment, agents: List[LLMAgent]):
         """単一エージェントの行動（Unawareness: プロンプトで仮説隠蔽）"""
+        clock = time.perf_counter
+        t0 = clock()
         local_view, local_messages = agent.get_local_view(env, agents, view_range=VIEW_RANGE)
+        t1 = clock()
+        response, fingerprint = self._gated_response(agent, local_view, local_messages)
+        if response is not None:
+            # 状況が変わっていない: 前回の判断をそのまま適用（LLMは呼ばない）。
+            # 一度譲って、gatherで並ぶ他の個体が視界を読み終えてから適用する
+            await asyncio.sleep(0)
+            self._commit(agent, response, env, agents)
+            if self.profiler is not None:
+                self.profiler.record('local_view', t1 - t0)
+                self.profiler.record('apply', clock() - t1)
+            return
         system_prompt, user_prompt = agent.build_prompt(local_view, local_messages, len(agents))
-    
+        t2 = clock()
+        response = await self._decide(agent, system_prompt, user_prompt)
+        self._remember(agent, fingerprint, response)
+        t3 = clock()
+        self._commit(agent, response, env, agents)
+        if self.profiler is not None:
+            self.profiler.record_agent(agent.id, (t1 - t0, t2 - t1, t3 - t2, clock() - t3))
+
+    def _prepare(self, agent: LLMAgent, env: Environment,
+                 agents: List[LLMAgent]) -> Tuple[Optional[Tuple[str, str]], Optional[str], Optional[int]]:
+        """視界を読んでゲートに掛ける。戻り値 (プロンプト or None, 使い回す応答 or None, 指紋)"""
+        clock = time.perf_counter
+        t0 = clock()
+        local_view, local_messages = agent.get_local_view(env, agents, view_range=VIEW_RANGE)
+        t1 = clock()
+        response, fingerprint = self._gated_response(agent, local_view, local_messages)
+        prompts = agent.build_prompt(local_view, local_messages, len(agents)) if response is None else None
+        if self.profiler is not None:
+            self.profiler.record('local_view', t1 - t0)
+            if prompts is not None:
+                self.profiler.record('build_prompt', clock() - t1)
+        return prompts, response, fingerprint
+
+    def _gated_response(self, agent: LLMAgent, local_view: List[str],
+                        local_messages: List[str]) -> Tuple[Optional[str], Optional[int]]:
+        """判断ゲート: (使い回す応答 or None, 指紋)。ゲート無し/再生中は (None, None)"""
+        if self.decision_gate is None or self.replayer is not None:
+            return None, None
+        fingerprint = self.decision_gate.fingerprint(agent, local_view, local_messages)
+        return self.decision_gate.lookup(agent.id, self.step_count, fingerprint), fingerprint
+
+    def _remember(self, agent: LLMAgent, fingerprint: Optional[int], response: str):
+        if fingerprint is not None:
+            self.decision_gate.store(agent.id, self.step_count, fingerprint, response)
+
+    def _commit(self, agent: LLMAgent, response: str, env: Environment, agents: List[LLMAgent]):
+        """適用してから記録（await無しで続けて呼ぶので記録順 = 適用順）。適用できなかった応答は記録しない"""
+        self._apply_response(agent, response, env, agents)
+        if self.recorder is not None:
+            self.recorder.record(self.step_count, agent.id, response)
+
+    async def _act_batch(self, batch: List[Tuple[LLMAgent, Tuple[str, str], Optional[int]]],
+                         env: Environment, agents: List[LLMAgent]):
+        """複数エージェントの判断を1リクエストにまとめる（batch は _prepare 済みの (agent, プロンプト, 指紋)）。
+        読めなかった個体だけ単発で聞き直す"""
+        clock = time.perf_counter
+        blocks = ["### Agent {}\nPersonality: {}\n\n{}".format(agent.id, agent.personality_prompt, prompts[1])
+                  for agent, prompts, _ in batch]
+        lore = batch[0][0].custom_world_prompt
+        system_prompt = (lore + "\n\n" if lore else "") + AGENT_RULES_PROMPT + BATCH_SYSTEM_SUFFIX
+        payload = {
+            "model": batch[0][0].model,
+            "messages": [{"role": "system", "content": system_prompt}, {"role": "user", "content": "\n\n".join(blocks)}],
+            "max_tokens": 150 * len(batch)
+        }
+        t0 = clock()
+        given_up = None  # 期限切れ/ブレーカー開: 単発で聞き直さず全員に代替応答
+        try:
+            answers = parse_batch_response(await self._call_llm(payload), [agent.id for agent, _, _ in batch])
+        except (LLMDeadlineExceeded, CircuitOpenError) as e:
+            answers = {}
+            given_up = self._fallback(e, "Batch of {}".format(len(batch)), count=len(batch))
+        except Exception as e:
+            print(f"⚠️ Batch of {len(batch)} LLM error: {e}")
+            answers = {}
+        if self.profiler is not None:
+            self.profiler.record('llm_batch', clock() - t0)
+        # 読めた分はawait無しで続けて適用（記録順 = 適用順）。適用で失敗した応答は読めなかった扱いで聞き直す
+        for agent, _, fingerprint in batch:
+            if agent.id in answers:
+                self._remember(agent, fingerprint, answers[agent.id])
+                try:
+                    self._commit(agent, answers[agent.id], env, agents)
+                except Exception as e:
+                    print(f"⚠️ Agent {agent.id} batch answer could not be applied: {e}")
+                    del answers[agent.id]
+        self.batch_stats['batches'] += 1
+        self.batch_stats['batched_agents'] += len(answers)
+        if given_up is not None:
+            for agent, _, _ in batch:
+                self._commit(agent, given_up, env, agents)
+            return
+        # 取りこぼしは従来の単発呼び出し
+        missing = [item for item in batch if item[0].id not in answers]
+        self.batch_stats['fallbacks'] += len(missing)
+        await asyncio.gather(*[self._act_single(agent, prompts, fingerprint, env, agents)
+                               for agent, prompts, fingerprint in missing])
+
+    async def _act_single(self, agent: LLMAgent, prompts: Tuple[str, str], fingerprint: Optional[int],
+                          env: Environment, agents: List[LLMAgent]):
+        response = await self._decide(agent, *prompts)
+        self._remember(agent, fingerprint, response)
+        self._commit(agent, response, env, agents)
+
+    async def _decide(self, agent: LLMAgent, system_prompt: str, user_prompt: str) -> str:
+        """LLMの生レスポンスを取得（再生/Mock/API）"""
+        if self.replayer is not None:
+            response = self.replayer.get(self.step_count, agent.id)
+            if response is None:
+                print(f"⚠️ Agent {agent.id} step {self.step_count}: no recorded response, Stay")
+                response = "Action: [Stay]\nThought: [No recorded response]"
+            return response
+
     # Mockモード (ダミーキーでテスト用、APIコールスキップ)
         if self.api_key == "APIキーはここに入れてね":
             response = "Action: [Stay]\nMessage: [Hello world]\nThought: [Safe choice in mock mode]"
         else:
-            response = "Action: [Stay]\nThought: [Error in reasoning]"  # デフォルト
+            payload = {
+                "model": agent.model,
+                "messages": [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}],
+                "max_tokens": 150
+            }
             try:
-                async with aiohttp.ClientSession() as session:
-                    payload = {
-                        "model": agent.model,
-                        "messages": [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}],
-                        "max_tokens": 150
-                    }
-                    headers = {"Authorization": f"Bearer {self.api_key}"}
-                    async with session.post("https://api.x.ai/v1/chat/completions", json=payload, headers=headers) as resp:
-                        result = await resp.json()
-                        response = result['choices'][0]['message']['content']
+                response = await self._call_llm(payload)
             except Exception as e:
-                print(f"⚠️ Agent {agent.id} LLM error: {e}")
-    
+                response = self._fallback(e, "Agent {}".format(agent.id))
+        return response
+
+    async def _call_llm(self, payload: Dict) -> str:
+        """call_deadline秒で打ち切る（打ち切った要求はキャンセル）。期限切れはLLMDeadlineExceeded"""
+        if self.call_deadline is None:
+            return await self.client.chat(payload)
+        task = asyncio.ensure_future(self.client.chat(payload))
+        try:
+            done, _ = await asyncio.wait([task], timeout=self.call_deadline)
+        finally:
+            if not task.done():
+                task.cancel()
+        if not done:
+            raise LLMDeadlineExceeded("no answer within {:.1f}s".format(self.call_deadline))
+        return task.result()
+
+    def _fallback(self, error: Exception, who: str, count: int = 1) -> str:
+        """LLMの失敗を分類して数え、代替応答（fallback_action）を返す"""
+        if isinstance(error, LLMDeadlineExceeded):
+            kind = 'deadline'
+        elif isinstance(error, CircuitOpenError):
+            kind = 'circuit_open'  # 開いている間は毎回出るので黙って数えるだけ
+        else:
+            kind = 'error'
+            print(f"⚠️ {who} LLM error: {error}")
+        self.fallback_stats[kind] += count
+        return fallback_response(self.fallback_action, kind)
+
+    def _apply_response(self, agent: LLMAgent, response: str, env: Environment, agents: List[LLMAgent]):
+        """レスポンスを解析して行動を世界に反映"""
     # レスポンス解析 (try外、全モード共通)
         action_match = re.search(r"Action:\s*\[(.*?)\]", response)
         thought_match = re.search(r"Thought:\s*\[(.*?)\]", response)
@@ -416,98 +2755,119 @@ class Simulation:
     
     # 行動実行 (try外、全モード共通)
         if agent.action.startswith("Move to"):
-            coords = re.findall(r'\((\d+),(\d+)\)', agent.action)
+            coords = re.findall(r'\((-?\d+),\s*(-?\d+)\)', agent.action)  # 西/北（負のオフセット）も読む
             if coords:  # ガード追加: coords空ならスキップ
                 dx, dy = int(coords[0][0]), int(coords[0][1])
                 agent.position = ((agent.position[0] + dx) % self.grid_size, (agent.position[1] + dy) % self.grid_size)
+                env.agent_index.move(agent.id, agent.position)
                 energy_gained = env.get_energy_at(agent.position)
                 if energy_gained > 0:
                     agent.energy += 50
+                    self.metrics.on_energy(agent, 50)
+                    self._event('pickup', agent.id, agent.position[0], agent.position[1], 50)
         elif agent.action.startswith("Share:"):
             parts = agent.action.split(":")[1].split("-") if ":" in agent.action else []
             if len(parts) == 2:
                 target_id, amount = int(parts[0]), int(parts[1])
-                target = next((a for a in agents if a.id == target_id and a.alive), None)
+                target = self.registry.get(target_id)
                 if target and amount <= agent.energy:
                     agent.energy -= amount
                     target.energy += amount
+                    self.metrics.on_energy(agent, -amount)
+                    self.metrics.on_energy(target, amount)
                     self.stats['shares'] += 1
+                    self._event('share', agent.id, target.id, amount)
         elif agent.action.startswith("Attack:"):
             if len(agent.action.split(":")) > 1:
                 target_id = int(agent.action.split(":")[1].strip())
-                target = next((a for a in agents if a.id == target_id and a.alive), None)
+                target = self.registry.get(target_id)
                 if target and self._in_view_range(agent.position, target.position):  # async対応
-                    agent.energy += target.energy // 2
-                    target.energy -= target.energy // 2
+                    stolen = target.energy // 2
+                    agent.energy += stolen
+                    target.energy -= stolen
+                    self.metrics.on_energy(agent, stolen)
+                    self.metrics.on_energy(target, -stolen)
+                    self._event('attack', agent.id, target.id, stolen, target.energy <= 0)
                     if target.energy <= 0:
-                        target.alive = False
-                        self.stats['total_died'] += 1
+                        self._mark_dead(target, cause='attack')
                     self.stats['attacks'] += 1
+        self.metrics.on_action(agent.action)  # 解釈できずに例外になった行動は数えない
     
         agent.age += 1
+        self.metrics.on_age(agent, agent.age - 1)
         agent.memory.append(f"Step {self.step_count}: {agent.thoughts[:100]}")
     
+    async def close(self):
+        """HTTPコネクションプールと記録ファイルを解放（実行終了時に必ず呼ぶ）。描画キューは書き切ってから止める"""
+        if self.render_queue is not None:
+            await self.render_queue.close()
+        if self.video is not None:
+            self.video.close()
+        await self.client.close()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.log_writer is not None:
+            self.log_writer.close()
+        if self.event_log is not None:
+            self.event_log.close()
+        if self.trajectory is not None:
+            self.trajectory.close()
+        if self.renderer is not None:
+            self.renderer.close()
+
+    @property
+    def agents(self) -> List[LLMAgent]:
+        """生存エージェント一覧（死亡個体は registry.archive に移動済み）"""
+        return self.registry.living()
+
+    def _action_cost(self, action: str) -> int:
+        """行動ごとのエネルギー消費（Move=2, Stay=1, Reproduce=reproduce_cost）"""
+        if action.startswith("Move"):
+            return 2
+        if action == "Stay":
+            return 1
+        if action == "Reproduce":
+            return self.reproduce_cost
+        return 0
+
+    def _event(self, table: str, *row):
+        """イベント表へ1行（先頭列のstepは自動付与）"""
+        if self.event_log is not None:
+            self.event_log.emit(table, self.step_count, *row)
+
+    def _mark_dead(self, agent: LLMAgent, cause: str = 'starvation'):
+        """死亡処理（空間インデックスからも外す）。攻撃で既に死んだ個体を二重に数えない"""
+        if not agent.alive:
+            return
+        agent.alive = False
+        self.stats['total_died'] += 1
+        self.metrics.on_death(agent)
+        self._event('death', agent.id, cause, agent.age, agent.energy)
+        self.environment.agent_index.remove(agent.id)
+        self.message_bus.discard(agent.id)
+        if self.decision_gate is not None:
+            self.decision_gate.discard(agent.id)
+
     def _random_nearby_pos(self, pos: Tuple[int, int]) -> Tuple[int, int]:
         dx, dy = random.choice([(-1,0), (1,0), (0,-1), (0,1)])
         return ((pos[0] + dx) % self.grid_size, (pos[1] + dy) % self.grid_size)
     
     def _in_view_range(self, pos1: Tuple[int, int], pos2: Tuple[int, int], range_val: int = VIEW_RANGE) -> bool:
-        dx = abs(pos1[0] - pos2[0])
-        dy = abs(pos1[1] - pos2[1])
+        # 移動がトーラスなので視界判定もトーラス最短距離
+        dx = abs(torus_delta(pos1[0], pos2[0], self.grid_size))
+        dy = abs(torus_delta(pos1[1], pos2[1], self.grid_size))
         return dx <= range_val and dy <= range_val
     
-    def visualize(self, save_path: Optional[str] = None):
-        """ビジュアライズ（メトリクス + MBTI表示拡張） - Legend修正"""
-        fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(15, 7))
-        
-        # 環境描画
-        ax1.clear()
-        ax1.set_xlim(-1, self.environment.size)
-        ax1.set_ylim(-1, self.environment.size)
-        
-        # Legend labels取得
-        handles, existing_labels = ax1.get_legend_handles_labels()
-        
-        # エネルギー源
-        for pos, _ in self.environment.energy_sources.items():
-            ax1.scatter(pos[0], pos[1], c='orange', s=100, marker='s', alpha=0.7, 
-                       label='Energy' if 'Energy' not in existing_labels else "")
-            handles, existing_labels = ax1.get_legend_handles_labels()
-        
-        # エージェント（MBTI色分け例: ランダム色）
-        living_agents = [a for a in self.agents if a.alive]
-        mbti_colors = {t: random.choice(['blue', 'red', 'green', 'purple', 'orange', 'cyan']) for t in MBTI_TYPES}
-        for agent in living_agents:
-            if self.use_mbti:
-                color = mbti_colors.get(agent.mbti_type, 'gray')
-                label = f'{agent.mbti_type}' if agent.mbti_type not in existing_labels else ""
-                ax1.scatter(agent.position[0], agent.position[1], c=color, s=agent.energy / 3, alpha=0.8, label=label)
-                handles, existing_labels = ax1.get_legend_handles_labels()
-            else:
-                color = 'green' if agent.energy > 50 else 'red'
-                label = 'Agent' if 'Agent' not in existing_labels else ""
-                ax1.scatter(agent.position[0], agent.position[1], c=color, s=agent.energy / 3, alpha=0.8, label=label)
-                handles, existing_labels = ax1.get_legend_handles_labels()
-        
-        ax1.grid(True, alpha=0.3, linestyle='--')
-        ax1.legend(loc='upper left', fontsize=8)
-        ax1.set_xlabel('X Position')
-        ax1.set_ylabel('Y Position')
-        title = 'Environment - Step {} (MBTI Agents - Real Pop Dist)'.format(self.step_count) if self.use_mbti else 'Environment - Step {} (No MBTI)'.format(self.step_count)
-        ax1.set_title(title, fontsize=14, weight='bold')
-        
-        alive_count = len(living_agents)
-        total_energy = sum(a.energy for a in living_agents)
-        avg_age = np.mean([a.age for a in living_agents]) if living_agents else 0
-        max_age = max([a.age for a in living_agents]) if living_agents else 0
+    def frame_snapshot(self) -> 'FrameSnapshot':
+        """描画に必要な状態を不変スナップショットに固める（描画側はSimulationに触れない）"""
+        living_agents = self.agents
+        population = self.metrics.snapshot()
+        alive_count = population['alive']
+        total_energy = population['total_energy']
         
         # メトリクス追加表示（HATE + 生存本能 + MBTI分布サンプル）
-        total_actions = alive_count * self.step_count
-        coop_rate = self.stats['shares'] / total_actions if total_actions > 0 else 0
-        attack_rate = self.stats['attacks'] / total_actions if total_actions > 0 else 0
-        repro_rate = self.stats['reproductions'] / total_actions if total_actions > 0 else 0
-        
-        mbti_sample = {k: f"{v*100:.1f}%" for k, v in list({t: sum(1 for a in living_agents if a.mbti_type == t) / len(living_agents) if living_agents else 0 for t in MBTI_TYPES}.items())[:4]} if self.use_mbti else "N/A"
+        rates = self.metrics.rates(self.stats)
+        mbti_sample = {k: f"{c / alive_count * 100 if alive_count else 0:.1f}%" for k, c in list(population['mbti_counts'].items())[:4]} if self.use_mbti else "N/A"
         
         stats_text = """
         === Population Statistics ===
@@ -544,66 +2904,251 @@ class Simulation:
             total_energy,
             total_energy / alive_count if alive_count > 0 else 0,
             len(self.environment.energy_sources),
-            avg_age,
-            max_age,
+            population['avg_age'],
+            population['max_age'],
             self.stats['attacks'],
             self.stats['shares'],
-            coop_rate,
-            attack_rate,
-            repro_rate,
+            rates['coop_rate'],
+            rates['attack_rate'],
+            rates['repro_rate'],
             mbti_sample)
+        title = 'Environment - Step {} (MBTI Agents - Real Pop Dist)'.format(self.step_count) if self.use_mbti else 'Environment - Step {} (No MBTI)'.format(self.step_count)
         
-        ax2.text(0.05, 0.5, stats_text, transform=ax2.transAxes,
-                fontsize=10, verticalalignment='center', family='monospace',
-                bbox=dict(boxstyle='round', facecolor='wheat', alpha=0.5))
-        ax2.axis('off')
-        
-        plt.tight_layout()
+        def frozen(values, dtype, shape=None):
+            arr = np.array(values, dtype=dtype)
+            if shape is not None:
+                arr = arr.reshape(shape)
+            arr.flags.writeable = False
+            return arr
         
+        return FrameSnapshot(
+            step=self.step_count,
+            grid_size=self.environment.size,
+            use_mbti=self.use_mbti,
+            energy_xy=frozen(self.environment.energy_sources.positions(), float, (-1, 2)),
+            agent_xy=frozen([a.position for a in living_agents], float, (-1, 2)),
+            agent_energy=frozen([a.energy for a in living_agents], float),
+            agent_mbti=frozen([MBTI_TYPES.index(a.mbti_type) if a.mbti_type in MBTI_TYPES else -1
+                               for a in living_agents], np.int8),
+            title=title,
+            stats_text=stats_text
+        )
+
+    async def render_frame(self, save_path: Optional[str]):
+        """現在の状態を描画（save_pathへPNG、videoがあれば動画にも1フレーム）。描画キューがあれば積むだけで戻る"""
+        if self.render_queue is not None:
+            await self.render_queue.submit(self.frame_snapshot(), save_path, self.video)
+            return
         if save_path:
-            plt.savefig(save_path, dpi=150, bbox_inches='tight')
-            print("📸 Saved: {}".format(save_path))
-        else:
+            self.visualize(save_path)
+        if self.video is not None:
+            write_video_frame(self.video, self.frame_snapshot(), self)
+
+    def visualize(self, save_path: Optional[str] = None):
+        """ビジュアライズ（メトリクス + MBTI表示拡張）。図は使い回し、層ごとに1回のscatter更新"""
+        if save_path is None:
             save_path = "step_{}.png".format(self.step_count)
-            plt.savefig(save_path, dpi=150, bbox_inches='tight')
-            print("📸 Saved: {}".format(save_path))
-        
-        plt.close(fig)
+        if self.renderer is None:
+            self.renderer = FrameRenderer()
+        self.renderer.render(self.frame_snapshot(), save_path)
+        print("📸 Saved: {}".format(save_path))
 
     def get_summary(self) -> Dict:
-        living_agents = [a for a in self.agents if a.alive]
-        total_actions = len(living_agents) * self.step_count
-        coop_rate = self.stats['shares'] / total_actions if total_actions > 0 else 0
-        attack_rate = self.stats['attacks'] / total_actions if total_actions > 0 else 0
-        repro_rate = self.stats['reproductions'] / total_actions if total_actions > 0 else 0
-        
-        # 修正: mbti_distをifで分岐（空時0dictで安全）
-        if self.use_mbti:
-            if living_agents:
-                mbti_dist = {t: sum(1 for a in living_agents if a.mbti_type == t) / len(living_agents) for t in MBTI_TYPES}
-            else:
-                mbti_dist = {t: 0 for t in MBTI_TYPES}  # 空時明示0
-        else:
-            mbti_dist = {}
+        population = self.metrics.snapshot()
+        alive_count = population['alive']
+        rates = self.metrics.rates(self.stats)
+        mbti_dist = self.metrics.mbti_distribution() if self.use_mbti else {}  # 空時は全タイプ0
         
         return {
             'step': self.step_count,
-            'alive': len(living_agents),
+            'alive': alive_count,
             'total_born': self.stats['total_born'],
             'total_died': self.stats['total_died'],
-            'total_energy': sum(a.energy for a in living_agents),
-            'avg_age': np.mean([a.age for a in living_agents]) if living_agents else 0,
+            'total_energy': population['total_energy'],
+            'avg_age': population['avg_age'],
             'attacks': self.stats['attacks'],
             'shares': self.stats['shares'],
             'reproductions': self.stats['reproductions'],
-            'coop_rate': coop_rate,
-            'attack_rate': attack_rate,
-            'repro_rate': repro_rate,
+            'total_actions': population['total_actions'],
+            'coop_rate': rates['coop_rate'],
+            'attack_rate': rates['attack_rate'],
+            'repro_rate': rates['repro_rate'],
             'mbti_distribution': mbti_dist
         }
 
 
-async def main(run_id=0, params: Optional[Dict] = None):  
+TICK_MODELS = ('action', 'time')
+
+
+class EventScheduler:
+    """バリア無しのイベント駆動スケジューラ（Simulation.step を回す代わり）
+
+    各エージェントが自分の時計で動く: 起床 → 視界を読んでLLMに聞く → 返ったら現在の世界に対して即適用 → 次の起床を
+    優先度付きキュー（起床時刻順）へ。全員を待つ gather の壁が無いので、遅い個体がいても他の個体とAPIは止まらない。
+
+    - 1ティック = tick_seconds 秒（壁時計）。ティックの始めにエネルギー湧き、終わりに軌跡/台帳整理/ステップログ（step = ティック番号）
+    - 起床間隔は最短 min_interval ティック（応答がそれより遅ければ返った時点ですぐ次へ）。max_in_flight で同時判断数を抑える
+    - tick_model='action': stepと同じ行動ごとのコスト / 'time': 前回の精算から跨いだティック数 × metabolism（+ 生殖コスト）
+    - 視界の読み取りと行動の適用はawaitを挟まずに行うので、どの読み取りも適用し終えた行動だけを含む一貫した状態を見る。
+      判断中に死んだ個体の応答は捨て、攻撃の射程などは適用時点の位置で判定する
+    - 1体ずつの呼び出しなので batch_size は使わない。起床順が壁時計の遅延で決まるため再生（replayer）と方策（policy）には非対応
+    """
+
+    def __init__(self, sim: Simulation, tick_seconds: float = TICK_SECONDS, tick_model: str = 'action',
+                 metabolism: int = 1, min_interval: float = 1.0, max_in_flight: Optional[int] = None):
+        if tick_model not in TICK_MODELS:
+            raise ValueError("Unknown tick_model: {}".format(tick_model))
+        if sim.replayer is not None or sim.policy is not None:
+            raise ValueError("EventScheduler supports live/record LLM decisions only (no replay, no policy)")
+        self.sim = sim
+        self.tick_seconds = tick_seconds
+        self.tick_model = tick_model
+        self.metabolism = metabolism
+        self.min_interval = min_interval
+        self.max_in_flight = max_in_flight
+        self.ticks = 0
+        self._heap = []  # (起床時刻[ティック], 通し番号, agent_id)
+        self._seq = 0
+        self._last_charge = {}  # agent_id -> 最後に精算した時刻（tick_model='time'）
+        self._start = time.monotonic()
+        self.stats = {'decisions': 0, 'failed_actions': 0, 'dropped_dead': 0, 'cancelled': 0, 'max_in_flight': 0}
+
+    def now(self) -> float:
+        """開始からの経過ティック"""
+        return (time.monotonic() - self._start) / self.tick_seconds
+
+    def _schedule(self, agent: LLMAgent, at: float):
+        heapq.heappush(self._heap, (at, self._seq, agent.id))
+        self._seq += 1
+
+    def _can_launch(self, in_flight: set) -> bool:
+        return self.max_in_flight is None or len(in_flight) < self.max_in_flight
+
+    async def run(self, num_ticks: int, on_tick=None):
+        """num_ticks ティック回す（全滅したら打ち切り）。on_tick(step) はティックの締めのたびにawaitされる"""
+        sim = self.sim
+        self._start = time.monotonic()
+        for agent in sim.registry.living():
+            self._schedule(agent, 0.0)
+            self._last_charge[agent.id] = 0.0
+        in_flight = set()
+        self._begin_tick()
+        try:
+            while self.ticks < num_ticks and sim.metrics.alive > 0:
+                now = self.now()
+                if now >= self.ticks + 1:
+                    self._end_tick()
+                    if on_tick is not None:
+                        await on_tick(sim.step_count)
+                    if self.ticks < num_ticks:
+                        self._begin_tick()
+                    continue
+                # 起床時刻の来た個体を判断に出す（死んでいれば捨てる）
+                while self._heap and self._heap[0][0] <= now and self._can_launch(in_flight):
+                    _, _, agent_id = heapq.heappop(self._heap)
+                    agent = sim.registry.get(agent_id)
+                    if agent is not None:
+                        in_flight.add(asyncio.ensure_future(self._wake(agent)))
+                self.stats['max_in_flight'] = max(self.stats['max_in_flight'], len(in_flight))
+                # 次のイベント（判断の完了/次の起床/ティック境界）まで待つ
+                wake_at = self.ticks + 1
+                if self._heap and self._can_launch(in_flight):
+                    wake_at = min(wake_at, self._heap[0][0])
+                timeout = max(0.0, (wake_at - now) * self.tick_seconds)
+                if in_flight:
+                    done, in_flight = await asyncio.wait(in_flight, timeout=timeout,
+                                                         return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        if task.exception() is not None:
+                            print(f"⚠️ Agent wake-up failed: {task.exception()}")
+                else:
+                    await asyncio.sleep(timeout)
+        finally:
+            # 終了時点で判断中の個体は打ち切る（世界には適用しない）
+            for task in in_flight:
+                task.cancel()
+            self.stats['cancelled'] += len(in_flight)
+            if in_flight:
+                await asyncio.gather(*in_flight, return_exceptions=True)
+
+    def _begin_tick(self):
+        sim = self.sim
+        sim.step_count += 1
+        sim.metrics.begin_step()
+        sim.environment.random_spawn()
+
+    def _end_tick(self):
+        sim = self.sim
+        if sim.profiler is not None:
+            sim.profiler.start_step()  # 'step' = ティックの締めにかかった時間
+        # 軌跡は台帳にいる全員（判断待ちの個体、このティックに死んだ個体と新生児も含む）
+        sim._finish_step(list(sim.registry.active.values()))
+        self.ticks += 1
+
+    async def _wake(self, agent: LLMAgent):
+        """1体の判断: 視界/プロンプトの読み取りまではawait無し（一貫した状態）→ LLM → 適用 → 次の起床を予約"""
+        sim = self.sim
+        woke = self.now()
+        try:
+            agent.messages = sim.message_bus.collect(agent.id)
+            local_view, local_messages = agent.get_local_view(sim.environment, [], view_range=VIEW_RANGE)
+            response, fingerprint = sim._gated_response(agent, local_view, local_messages)
+            if response is None:
+                system_prompt, user_prompt = agent.build_prompt(local_view, local_messages, sim.metrics.alive)
+                started = time.perf_counter()
+                response = await sim._decide(agent, system_prompt, user_prompt)
+                sim._remember(agent, fingerprint, response)
+                if sim.profiler is not None:
+                    sim.profiler.record('llm', time.perf_counter() - started)
+            self._resolve(agent, response)
+        finally:
+            # 途中で失敗しても生きていれば必ず次の起床を予約（予約が漏れると行動しないまま生き続ける）
+            if agent.alive:
+                self._schedule(agent, max(self.now(), woke + self.min_interval))
+
+    def _resolve(self, agent: LLMAgent, response: str):
+        """応答を現在の世界に適用してエネルギーを精算（判断中に死んでいた個体の応答は捨てる）"""
+        sim = self.sim
+        if not agent.alive:
+            self.stats['dropped_dead'] += 1
+            return
+        self.stats['decisions'] += 1
+        try:
+            sim._commit(agent, response, sim.environment, [])
+        except Exception as e:
+            # 解釈できない応答は失敗した行動（Stay）として扱い、精算は続ける
+            print(f"⚠️ Agent {agent.id} action failed: {e}")
+            self.stats['failed_actions'] += 1
+            agent.action = "Stay"
+            sim.metrics.on_action(agent.action)
+        sim._publish(agent)
+        now = self.now()
+        reproduce = agent.action == "Reproduce"
+        if self.tick_model == 'action':
+            cost = sim._action_cost(agent.action)
+        else:
+            cost = self.metabolism * (int(now) - int(self._last_charge.get(agent.id, now)))
+            cost += sim.reproduce_cost if reproduce else 0
+        self._last_charge[agent.id] = now
+        if reproduce:
+            sim.stats['reproductions'] += 1
+            alive_before = sim.metrics.alive
+        sim._charge(agent, cost)
+        if reproduce and alive_before < 60:
+            child = sim._spawn_child(agent)
+            self._schedule(child, now)
+            self._last_charge[child.id] = now
+
+    def summary(self) -> Dict:
+        elapsed = time.monotonic() - self._start
+        stats = dict(self.stats)
+        stats.update(ticks=self.ticks, elapsed_s=elapsed,
+                     decisions_per_sec=self.stats['decisions'] / elapsed if elapsed > 0 else 0.0)
+        return stats
+
+
+async def main(run_id=0, params: Optional[Dict] = None, http_session: Optional[aiohttp.ClientSession] = None):
+    # http_session: batch_experimentなどで複数runにまたがって共有する接続プール（None時はSimulationが自前で作成）
     # パラメータオーバーライド（try外に移動してexceptで使えるように）
     default_params = {
         'num_agents': 5,
@@ -620,11 +3165,58 @@ async def main(run_id=0, params: Optional[Dict] = None):
         'num_clusters': NUM_CLUSTERS,
         'energy_spawn_rate': ENERGY_SPAWN_RATE,
         'custom_world_prompt': CUSTOM_WORLD_PROMPT,
+        'api_url': API_URL,
+        'pool_limit': HTTP_POOL_LIMIT,
+        'pool_limit_per_host': HTTP_POOL_LIMIT_PER_HOST,
+        'rate_limit_rpm': RATE_LIMIT_RPM,
+        'rate_limit_tpm': RATE_LIMIT_TPM,
+        'max_concurrent_requests': MAX_CONCURRENT_REQUESTS,
+        'max_retries': MAX_RETRIES,
+        'cache_path': None,  # 例: 'outputs/llm_cache.sqlite'
+        'cache_max_entries': CACHE_MAX_ENTRIES,
+        'cache_max_age': CACHE_MAX_AGE,
+        'llm_mode': 'live',  # 'live' | 'record'（生レスポンスを記録） | 'replay'（記録から再生、API不要）
+        'replay_path': None,  # 再生元。None時は outputs/run_XX/run_XX.decisions.jsonl
+        'inbox_limit': MESSAGE_INBOX_LIMIT,
+        'use_agent_store': True,  # エージェント数値状態をNumPy列で保持
+        'log_history': LOG_HISTORY,  # run_XX.jsonの'logs'に残す直近ステップ数（全履歴は run_XX.steps.jsonl）
+        'log_compression': None,  # None | 'gzip' | 'zstd'
+        'log_flush_every': LOG_FLUSH_EVERY,
+        'log_fsync_every': LOG_FSYNC_EVERY,
+        'log_keyframe_every': LOG_KEYFRAME_EVERY,  # 差分ログのキーフレーム間隔（0で毎ステップ全量）
+        'event_format': 'auto',  # 'auto'(pyarrowあればparquet) | 'parquet' | 'arrow' | 'npz' | None(無効)
+        'event_row_group': EVENT_ROW_GROUP,
+        'render_async': True,  # フレーム描画をワーカースレッドで（Falseで従来どおりループ内で同期描画）
+        'render_queue_size': RENDER_QUEUE_SIZE,
+        'batch_size': 1,  # >1 で複数エージェントの判断を1リクエストに（読めなかった個体は単発で再要求）
+        'call_deadline': None,  # 秒。1回の判断（待ち/リトライ込み）の期限、超えたら fallback_action（Noneで無制限）
+        'fallback_action': FALLBACK_ACTION,
+        'hedge_percentile': None,  # 例: 95。この分位のレイテンシを過ぎた呼び出しに重複要求を出す（Noneで無効）
+        'breaker_failures': 0,  # >0 で連続この回数の5xx/通信エラーでエンドポイントへの送信を止める
+        'breaker_reset': BREAKER_RESET_TIMEOUT,
+        'scheduler': 'step',  # 'step'(全員そろえて1ステップ) | 'event'(バリア無し、エージェントごとの時計。num_stepsはティック数)
+        'tick_seconds': TICK_SECONDS,  # event: 1ティックの壁時計秒
+        'tick_model': 'action',  # event: 'action'(行動ごとのコスト) | 'time'(経過ティック × metabolism)
+        'metabolism': 1,
+        'min_interval': 1.0,  # event: 同じエージェントの起床間隔の下限（ティック）
+        'max_in_flight': None,  # event: 同時に判断中のエージェント数の上限（Noneで無制限、実際の同時送信はmax_concurrent_requests）
+        'gate_max_stale': 0,  # >0 で判断ゲート: 視界/受信/エネルギー帯が変わらない個体は最大このステップ数まで前回の判断を使い回す
+        'gate_energy_band': GATE_ENERGY_BAND,
+        'policy': 'llm',  # 'llm' | 'heuristic'（NumPyルール方策でAPI無しに全員を一括判断、乱数はseedから）
+        'profile': False,  # フェーズ別タイマー（run_XX.profile.json + コンソール表）
+        'frame_every': 5,  # 何ステップごとにフレームを描くか
+        'frame_output': 'png',  # 'png'(step_XXX.png) | 'video'(1本の動画) | 'both'
+        'video_format': 'auto',  # 'auto'(ffmpegあればmp4、無ければgif) | 'mp4' | 'webm' | 'gif' | 'apng'
+        'video_fps': VIDEO_FPS,
+        'video_max_fallback_frames': VIDEO_FALLBACK_MAX_FRAMES,  # gif/apng（ffmpeg無し）で動画に入れるフレーム数の上限
+        'trajectory': True,  # run_XX.traj（np.memmapで開ける数値軌跡）を書く
         'api_key': "APIキーはここに入れてね"  # デフォルトMock
     }
     if params:
         default_params.update(params)
 
+    sim = None
+    recorder = log_writer = event_log = trajectory = video = None  # Simulation生成前に失敗したらfinallyで閉じる
     try:  # 新: ここから全体をtryで囲む
         print("=" * 60)
         print("LLM Sugarscape Experiment  MBTI  - Run {:02d}".format(run_id).center(60))
@@ -647,7 +3239,61 @@ async def main(run_id=0, params: Optional[Dict] = None):
         run_dir_name = 'run_{:02d}'.format(run_id)  
         run_dir = json_output_dir / run_dir_name
         run_dir.mkdir(exist_ok=True)
+        decisions_file = run_dir / '{}.decisions.jsonl'.format(run_dir_name)
+
+        # 出力ファイルを開く前に設定を検証（不正な値で途中まで開いたファイルを残さない）
+        frame_output = default_params['frame_output']
+        if frame_output not in ('png', 'video', 'both'):
+            raise ValueError("Unknown frame_output: {}".format(frame_output))
+        if frame_output in ('video', 'both'):
+            FrameVideoWriter.resolve_format(default_params['video_format'])
+        policy_name = default_params['policy']
+        if policy_name == 'heuristic':
+            policy = HeuristicPolicy(seed=SEED)
+        elif policy_name == 'llm':
+            policy = None
+        else:
+            raise ValueError("Unknown policy: {}".format(policy_name))
+        if default_params['scheduler'] not in ('step', 'event'):
+            raise ValueError("Unknown scheduler: {}".format(default_params['scheduler']))
+        if default_params['scheduler'] == 'event' and default_params['tick_model'] not in TICK_MODELS:
+            raise ValueError("Unknown tick_model: {}".format(default_params['tick_model']))
+        if default_params['scheduler'] == 'event' and (policy is not None or default_params['llm_mode'] == 'replay'):
+            raise ValueError("EventScheduler supports live/record LLM decisions only (no replay, no policy)")
+
+        # 記録/再生モード（再生結果は元のrunを上書きしないよう run_XX/replay/ に出力）
+        llm_mode = default_params['llm_mode']
+        replayer = None
+        if llm_mode == 'replay':
+            replayer = DecisionReplayer(default_params['replay_path'] or str(decisions_file))
+            print(" Replay mode: {}".format(replayer.path))
+            run_dir = run_dir / 'replay'
+            run_dir.mkdir(exist_ok=True)
+        elif llm_mode == 'record':
+            recorder = DecisionRecorder(str(decisions_file), run_id=run_id)
+        elif llm_mode != 'live':
+            raise ValueError("Unknown llm_mode: {}".format(llm_mode))
+
         output_file = run_dir / '{}.json'.format(run_dir_name)
+        log_file = run_dir / '{}.steps.jsonl{}'.format(run_dir_name, LOG_SUFFIXES.get(default_params['log_compression'], ''))
+        log_writer = StepLogWriter(str(log_file), compression=default_params['log_compression'],
+                                   flush_every=default_params['log_flush_every'],
+                                   fsync_every=default_params['log_fsync_every'],
+                                   keyframe_every=default_params['log_keyframe_every'])
+        event_log = None
+        if default_params['event_format']:
+            event_log = EventLog(str(run_dir / 'events'), fmt=default_params['event_format'],
+                                 row_group_size=default_params['event_row_group'])
+        trajectory = None
+        traj_file = run_dir / f"run_{run_id:02d}.traj"
+        if default_params['trajectory']:
+            trajectory = TrajectoryWriter(str(traj_file), default_params['grid_size'],
+                                          flush_every=default_params['log_flush_every'])
+        if frame_output in ('video', 'both'):
+            video = FrameVideoWriter(str(run_dir / run_dir_name), fmt=default_params['video_format'],
+                                     fps=default_params['video_fps'],
+                                     max_fallback_frames=default_params['video_max_fallback_frames'])
+        write_png = frame_output in ('png', 'both')
         img_dir = run_dir / 'img'
         img_dir.mkdir(exist_ok=True)
 
@@ -665,32 +3311,121 @@ async def main(run_id=0, params: Optional[Dict] = None):
             cluster_radius=default_params['cluster_radius'],
             num_clusters=default_params['num_clusters'],
             energy_spawn_rate=default_params['energy_spawn_rate'],
-            custom_world_prompt=default_params['custom_world_prompt']
+            custom_world_prompt=default_params['custom_world_prompt'],
+            api_url=default_params['api_url'],
+            http_session=http_session,
+            pool_limit=default_params['pool_limit'],
+            pool_limit_per_host=default_params['pool_limit_per_host'],
+            rate_limit_rpm=default_params['rate_limit_rpm'],
+            rate_limit_tpm=default_params['rate_limit_tpm'],
+            max_concurrent_requests=default_params['max_concurrent_requests'],
+            max_retries=default_params['max_retries'],
+            cache_path=default_params['cache_path'],
+            cache_max_entries=default_params['cache_max_entries'],
+            cache_max_age=default_params['cache_max_age'],
+            recorder=recorder,
+            replayer=replayer,
+            inbox_limit=default_params['inbox_limit'],
+            use_agent_store=default_params['use_agent_store'],
+            log_writer=log_writer,
+            log_history=default_params['log_history'],
+            event_log=event_log,
+            trajectory=trajectory,
+            render_queue=RenderQueue(default_params['render_queue_size']) if default_params['render_async'] else None,
+            video=video,
+            profiler=StepProfiler() if default_params['profile'] else None,
+            batch_size=default_params['batch_size'],
+            policy=policy,
+            call_deadline=default_params['call_deadline'],
+            fallback_action=default_params['fallback_action'],
+            hedge_percentile=default_params['hedge_percentile'],
+            breaker_failures=default_params['breaker_failures'],
+            breaker_reset=default_params['breaker_reset'],
+            decision_gate=DecisionGate(default_params['gate_max_stale'], default_params['gate_energy_band'])
+                          if default_params['gate_max_stale'] > 0 else None
         )
 
         print("Initial state (MBTI assigned w/ real pop %):")
+        async def render_frame(save_path):
+            # 描画（非同期時はスナップショット作成とキュー投入）もフェーズとして測る
+            started = time.perf_counter()
+            await sim.render_frame(save_path)
+            if sim.profiler is not None:
+                sim.profiler.record('render', time.perf_counter() - started)
+
         initial_path = img_dir / 'step_{:03d}.png'.format(0)
-        sim.visualize(save_path=str(initial_path))
+        await render_frame(str(initial_path) if write_png else None)
         print(" Starting...")
 
-        for step in range(NUM_STEPS):
-            await sim.step()
-            
-            if (step + 1) % 5 == 0:
-                viz_path = img_dir / 'step_{:03d}.png'.format(step+1)
-                sim.visualize(save_path=str(viz_path))
-                print(" Saved: {}".format(viz_path.name))
-            
-            if sum(1 for a in sim.agents if a.alive) == 0:
+        scheduler = None
+        if default_params['scheduler'] == 'event':
+            # バリア無し: 各エージェントが自分の時計で判断/適用、num_steps はティック数
+            scheduler = EventScheduler(sim, tick_seconds=default_params['tick_seconds'],
+                                       tick_model=default_params['tick_model'], metabolism=default_params['metabolism'],
+                                       min_interval=default_params['min_interval'],
+                                       max_in_flight=default_params['max_in_flight'])
+
+            async def on_tick(tick):
+                if tick % default_params['frame_every'] == 0:
+                    viz_path = img_dir / 'step_{:03d}.png'.format(tick)
+                    await render_frame(str(viz_path) if write_png else None)
+
+            await scheduler.run(NUM_STEPS, on_tick=on_tick)
+            if not sim.agents:
                 print("\n  All agents died!")
-                break
+        else:
+            for step in range(NUM_STEPS):
+                await sim.step()
+                
+                if (step + 1) % default_params['frame_every'] == 0:
+                    viz_path = img_dir / 'step_{:03d}.png'.format(step+1)
+                    await render_frame(str(viz_path) if write_png else None)
+                
+                if not sim.agents:
+                    print("\n  All agents died!")
+                    break
 
+        if sim.render_queue is not None:
+            await sim.render_queue.drain()  # 画像が揃ってからJSON/UIへ
+        if sim.video is not None:
+            sim.video.close()  # 動画と索引を確定（close済みなら何もしない）
+        profile_file = run_dir / '{}.profile.json'.format(run_dir_name)
+        if sim.profiler is not None:
+            sim.profiler.write(str(profile_file))
+            print("\n" + sim.profiler.format_table())
         summary = sim.get_summary()
+        llm_stats = sim.client.scheduler.stats.copy()  # リクエスト/リトライ/429/失敗回数
+        if sim.client.cache is not None:
+            llm_stats['cache'] = sim.client.cache.stats.copy()  # ヒット/ミス/削除数
+        if sim.replayer is not None:
+            llm_stats['replay'] = {'misses': sim.replayer.misses}  # 記録に無くStayで代用した判断の数（0以外は記録とずれた再生）
+            if sim.replayer.misses:
+                print(f"⚠️ Replay diverged from the recording: {sim.replayer.misses} decisions had no recorded response")
+        if sim.batch_size > 1:
+            llm_stats['batch'] = sim.batch_stats.copy()  # バッチ数/バッチで決まった人数/単発フォールバック数
+        if any(sim.fallback_stats.values()):
+            llm_stats['fallbacks'] = sim.fallback_stats.copy()  # 代替行動を適用した判断の数（error/deadline/circuit_open）
+        if sim.client.hedger is not None:
+            llm_stats['hedge'] = sim.client.hedger.stats.copy()
+        if sim.client.breaker is not None:
+            llm_stats['breaker'] = dict(sim.client.breaker.stats, state=sim.client.breaker.state)
+        if scheduler is not None:
+            llm_stats['event'] = scheduler.summary()  # ティック数/判断数/判断のスループット/打ち切り数
+        if sim.decision_gate is not None:
+            llm_stats['gate'] = sim.decision_gate.summary()  # 判断数/省いた数/聞き直した理由別の数
 
         full_data = {
             'config': default_params,
             'summary': summary,
-            'logs': sim.logs
+            'llm_stats': llm_stats,
+            'dead_agents': sim.registry.archived_records(),  # 死亡個体の最終状態
+            'log_path': str(log_file),  # 全ステップのJSONL
+            'trajectory_path': str(traj_file) if trajectory is not None else None,  # read_trajectory()で開く
+            'profile_path': str(profile_file) if sim.profiler is not None else None,
+            'video_path': str(video.path) if video is not None else None,  # 索引は <video_path>.frames.json
+            'event_counts': event_log.counts.copy() if event_log is not None else {},  # イベント表の行数
+            'message_stats': sim.message_bus.stats.copy(),  # 送信/配信/受信箱あふれで捨てた数
+            'logs': list(sim.logs)  # 直近log_history件
         }
 
         with open(output_file, 'w', encoding='utf-8') as f:
@@ -714,6 +3449,7 @@ async def main(run_id=0, params: Optional[Dict] = None):
         print("  Coop Rate:       {:.2f}".format(summary['coop_rate']))
         print("  Attack Rate:     {:.2f}".format(summary['attack_rate']))
         print("  Repro Rate:      {:.2f}".format(summary['repro_rate']))
+        print("  Messages:        sent {sent} / delivered {delivered} / dropped {dropped}".format(**sim.message_bus.stats))
         if USE_MBTI:
             print("  MBTI Dist Sample: {}".format({k: f"{v*100:.1f}%" for k, v in list(summary['mbti_distribution'].items())[:3]}))
 
@@ -730,6 +3466,14 @@ async def main(run_id=0, params: Optional[Dict] = None):
         }
         print(f"Returning error data: {error_data}")  # デバッグ用print
         return error_data
+
+    finally:
+        if sim is not None:
+            await sim.close()  # 接続プール解放
+        else:
+            for writer in (video, trajectory, event_log, log_writer, recorder):
+                if writer is not None:
+                    writer.close()
     
 # 並列実行 (低優先: multiprocessingで複数run同時実行)
 def run_wrapper(args):
@@ -764,6 +3508,10 @@ def run_streamlit_ui():
     use_mbti = st.sidebar.checkbox("Use MBTI (Real Pop Dist)", True)
     api_key = st.sidebar.text_input("Grok API Key", type="password", help="Mockモード時は空でOK")
     mock_mode = st.sidebar.checkbox("Mock Mode (No API Calls)", value=True)  # デフォルトでMock
+    api_url = st.sidebar.text_input("API Endpoint", value=API_URL, help="ローカルスタブ: python stub_server.py → http://127.0.0.1:8000/v1/chat/completions")
+    use_cache = st.sidebar.checkbox("Cache LLM Responses", value=False, help="同じプロンプトは outputs/llm_cache.sqlite から再利用（API課金なし）")
+    policy = st.sidebar.selectbox("Decision Policy", ['llm', 'heuristic'], index=0, help="heuristic: API無しのNumPyルール方策（MBTIで共有/攻撃の確率が変わる）")
+    frame_output = st.sidebar.selectbox("Frame Output", ['png', 'video', 'both'], index=0, help="video: ffmpegがあればMP4、無ければGIFの1ファイル")
 
     # エネルギー関連
     st.sidebar.subheader("Energy Settings")
@@ -805,6 +3553,10 @@ def run_streamlit_ui():
             'num_clusters': num_clusters,
             'energy_spawn_rate': energy_spawn_rate,
             'custom_world_prompt': custom_world_prompt,
+            'cache_path': 'outputs/llm_cache.sqlite' if use_cache else None,
+            'api_url': api_url,
+            'frame_output': frame_output,
+            'policy': policy,
             'api_key': effective_key  # effective_key = api_key if api_key and api_key != "APIキーはここに入れてね" else "APIキーはここに入れてね"  
         }
 
@@ -866,8 +3618,18 @@ def run_streamlit_ui():
                 images = list(Path(run_dir).glob('step_*.png'))
                 return sorted(images, key=lambda x: int(x.stem.split('_')[1]))[-3:] if images else []
             
+            video_path = st.session_state.result.get('video_path')
+            if video_path and Path(video_path).exists():
+                st.subheader("Animation")
+                if Path(video_path).suffix in ('.mp4', '.webm'):
+                    st.video(video_path)
+                else:
+                    st.image(video_path, use_column_width=True)  # GIF/APNGはそのまま再生される
+
             img_dir = Path('outputs/run_00/img')
-            if img_dir.exists():
+            if video_path and not any(img_dir.glob('step_*.png')):
+                pass  # 動画のみ出力
+            elif img_dir.exists():
                 images = load_images(str(img_dir))
                 if images:
                     st.subheader("Recent Visualizations")
@@ -914,10 +3676,15 @@ async def batch_experiment(num_runs_per_set=3, params_sets=None):
         ]
     
     results = []
-    for i, params in enumerate(params_sets):
-        for run_id in range(num_runs_per_set):
-            result = await main(run_id + i * num_runs_per_set, params)  # run_id調整
-            results.append(result)
+    # 全runで1つの接続プールを共有（run間でもKeep-Alive接続を再利用）
+    http_session = create_http_session()
+    try:
+        for i, params in enumerate(params_sets):
+            for run_id in range(num_runs_per_set):
+                result = await main(run_id + i * num_runs_per_set, params, http_session=http_session)  # run_id調整
+                results.append(result)
+    finally:
+        await http_session.close()
     
     # 結果集約JSON
     with open('outputs/batch_summary.json', 'w') as f:
@@ -0,0 +1,204 @@
+"""ローカルOpenAI互換スタブサーバー（/v1/chat/completions）
+
+ネットワーク無しで _agent_act の実I/O経路（接続プール/レート制限/リトライ/タイムアウト）を負荷試験するためのもの。
+レイテンシ分布・エラー率・429注入・行動（固定/ランダム/スクリプト）を設定できる。
+
+    python stub_server.py --port 8000 --latency lognormal --latency-ms 300 --rate-429 0.05 --actions random
+
+シミュレーション側は params の 'api_url' を http://127.0.0.1:8000/v1/chat/completions にし、
+api_key をダミー以外の任意文字列にする（"APIキーはここに入れてね" のままだと従来のMock分岐になる）。
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+from typing import Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+LATENCY_PROFILES = ['fixed', 'uniform', 'normal', 'lognormal', 'pareto']
+ACTION_MODES = ['stay', 'random', 'script']
+
+
+class StubConfig:
+    """スタブの振る舞い設定"""
+
+    def __init__(self, latency: str = 'fixed', latency_ms: float = 0.0, latency_spread: float = 0.5,
+                 error_rate: float = 0.0, rate_429: float = 0.0, retry_after: float = 1.0,
+                 actions: str = 'stay', script: Optional[List[str]] = None, seed: Optional[int] = None,
+                 batch_drop: float = 0.0):
+        if latency not in LATENCY_PROFILES:
+            raise ValueError("Unknown latency profile: {}".format(latency))
+        if actions not in ACTION_MODES:
+            raise ValueError("Unknown action mode: {}".format(actions))
+        if actions == 'script' and not script:
+            raise ValueError("actions='script' requires a non-empty script")
+        self.latency = latency
+        self.latency_ms = latency_ms  # 分布の中心（平均/中央値/スケール）
+        self.latency_spread = latency_spread  # fixed以外の広がり（uniform/normalは割合、lognormalはsigma、paretoはalpha逆数）
+        self.error_rate = error_rate  # 500を返す確率
+        self.rate_429 = rate_429  # 429 + Retry-Afterを返す確率
+        self.retry_after = retry_after
+        self.actions = actions
+        self.script = script or []
+        self.batch_drop = batch_drop  # バッチ要求で個々のエージェントの回答を省く確率（フォールバック試験用）
+        self.rng = random.Random(seed)
+
+    def sample_latency(self) -> float:
+        """1リクエストの応答遅延（秒）"""
+        base = self.latency_ms
+        if self.latency == 'fixed' or base <= 0:
+            ms = base
+        elif self.latency == 'uniform':
+            ms = self.rng.uniform(base * (1 - self.latency_spread), base * (1 + self.latency_spread))
+        elif self.latency == 'normal':
+            ms = self.rng.gauss(base, base * self.latency_spread)
+        elif self.latency == 'lognormal':
+            ms = self.rng.lognormvariate(0, self.latency_spread) * base  # 中央値 = base
+        else:  # pareto: 最小値 = base、重い裾
+            ms = self.rng.paretovariate(1 / max(self.latency_spread, 1e-6)) * base
+        return max(0.0, ms) / 1000
+
+
+def _visible_agent_ids(user_prompt: str) -> List[int]:
+    """Local Viewの '2=(dx,dy)=(...)' 行から視界内エージェントIDを拾う"""
+    return [int(m) for m in re.findall(r"^(\d+)=\(dx,dy\)", user_prompt, flags=re.MULTILINE)]
+
+
+BATCH_HEADER = re.compile(r"^### Agent (\d+)$", flags=re.MULTILINE)
+
+
+def random_action(rng: random.Random, user_prompt: str) -> str:
+    """視界内のエージェントを見て行動を1つ乱数で選ぶ（'Action: [...]' の中身。bench/engine.pyの偽クライアントも使う）"""
+    ids = _visible_agent_ids(user_prompt)
+    choices = ['move', 'move', 'move', 'stay', 'reproduce']
+    if ids:
+        choices += ['share', 'attack']
+    kind = rng.choice(choices)
+    if kind == 'move':
+        dx, dy = rng.choice([(1, 0), (-1, 0), (0, 1), (0, -1)])
+        return "Move to ({},{})".format(dx, dy)
+    if kind == 'share':
+        return "Share: {}-{}".format(rng.choice(ids), rng.randint(1, 20))
+    if kind == 'attack':
+        return "Attack: {}".format(rng.choice(ids))
+    if kind == 'reproduce':
+        return "Reproduce"
+    return "Stay"
+
+
+class StubServer:
+    """aiohttpアプリ本体（状態: リクエスト数/スクリプト位置）"""
+
+    def __init__(self, config: StubConfig):
+        self.config = config
+        self.stats = {'requests': 0, 'errors': 0, 'rate_limited': 0}
+        self._script_pos = 0
+
+    def _content(self, payload: Dict) -> str:
+        user_prompt = "\n".join(m.get('content', '') for m in payload.get('messages', []) if m.get('role') != 'system')
+        parts = BATCH_HEADER.split(user_prompt)
+        if len(parts) > 1:
+            # バッチ要求: '### Agent <id>' ごとに1ブロック返す
+            blocks = []
+            for agent_id, block in zip(parts[1::2], parts[2::2]):
+                if self.config.rng.random() < self.config.batch_drop:
+                    continue
+                blocks.append("### Agent {}\n{}".format(agent_id, self._answer(block)))
+            return "\n\n".join(blocks)
+        return self._answer(user_prompt)
+
+    def _answer(self, user_prompt: str) -> str:
+        cfg = self.config
+        if cfg.actions == 'script':
+            line = cfg.script[self._script_pos % len(cfg.script)]
+            self._script_pos += 1
+            if "Action:" in line:
+                return line  # 生レスポンスそのまま
+            action = line
+        elif cfg.actions == 'random':
+            action = random_action(cfg.rng, user_prompt)
+        else:
+            action = "Stay"
+        return "Action: [{}]\nMessage: [stub]\nThought: [stub decided {}]".format(action, action)
+
+    async def handle_completions(self, request: web.Request) -> web.Response:
+        cfg = self.config
+        payload = await request.json()
+        self.stats['requests'] += 1
+        await asyncio.sleep(cfg.sample_latency())
+        roll = cfg.rng.random()
+        if roll < cfg.rate_429:
+            self.stats['rate_limited'] += 1
+            return web.json_response({'error': {'message': 'rate limited (stub)'}}, status=429,
+                                     headers={'Retry-After': str(cfg.retry_after)})
+        if roll < cfg.rate_429 + cfg.error_rate:
+            self.stats['errors'] += 1
+            return web.json_response({'error': {'message': 'internal error (stub)'}}, status=500)
+        content = self._content(payload)
+        prompt_tokens = sum(len(m.get('content', '')) for m in payload.get('messages', [])) // 4
+        completion_tokens = len(content) // 4
+        return web.json_response({
+            'id': 'stub-{}'.format(self.stats['requests']),
+            'object': 'chat.completion',
+            'model': payload.get('model', 'stub'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                      'total_tokens': prompt_tokens + completion_tokens}
+        })
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats)
+
+    def make_app(self) -> web.Application:
+        app = web.Application(client_max_size=8 * 1024 * 1024)
+        app.router.add_post('/v1/chat/completions', self.handle_completions)
+        app.router.add_get('/stats', self.handle_stats)
+        return app
+
+
+async def start_stub_server(config: Optional[StubConfig] = None, host: str = '127.0.0.1',
+                            port: int = 8000) -> Tuple[web.AppRunner, StubServer]:
+    """同一プロセス内でスタブを起動（ベンチマーク用）。終了時は runner.cleanup() を呼ぶ"""
+    server = StubServer(config or StubConfig())
+    runner = web.AppRunner(server.make_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner, server
+
+
+def load_script(path: str) -> List[str]:
+    """行動スクリプト: JSON配列 or 1行1行動のテキスト（'Move to (1,0)' や生レスポンス全文）"""
+    with open(path, encoding='utf-8') as f:
+        text = f.read()
+    if text.lstrip().startswith('['):
+        return [str(x) for x in json.loads(text)]
+    return [line.strip() for line in text.splitlines() if line.strip()]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible stub for LLM Sugarscape")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', choices=LATENCY_PROFILES, default='fixed')
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--latency-spread', type=float, default=0.5)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-429', type=float, default=0.0)
+    parser.add_argument('--retry-after', type=float, default=1.0)
+    parser.add_argument('--actions', choices=ACTION_MODES, default='stay')
+    parser.add_argument('--script', default=None, help='actions=script用のファイル')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--batch-drop', type=float, default=0.0, help='バッチ要求で回答を省く確率')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    config = StubConfig(latency=args.latency, latency_ms=args.latency_ms, latency_spread=args.latency_spread,
+                        error_rate=args.error_rate, rate_429=args.rate_429, retry_after=args.retry_after,
+                        actions=args.actions, script=load_script(args.script) if args.script else None,
+                        seed=args.seed, batch_drop=args.batch_drop)
+    print("Stub listening on http://{}:{}/v1/chat/completions".format(args.host, args.port))
+    web.run_app(StubServer(config).make_app(), host=args.host, port=args.port, access_log=None, print=None)
@@ -0,0 +1,40 @@
+import asyncio
+import json
+
+import main
+
+
+def test_malformed_answer_in_batch_is_asked_again(tmp_path):
+    # バッチ中ほどの1体だけ 'Attack: Agent5'（int() で失敗）: 残りは適用され、その1体は単発で聞き直されること
+    recorder = main.DecisionRecorder(str(tmp_path / "decisions.jsonl"))
+    sim = main.Simulation(num_agents=6, grid_size=20, api_key='test', seed=4, log_history=1,
+                          energy_spawn_rate=0.0, batch_size=6, recorder=recorder)
+    bad_id = sim.agents[2].id
+    singles = []
+
+    async def chat(payload):
+        await asyncio.sleep(0)
+        ids = [int(i) for i in main.BATCH_HEADER.findall(payload['messages'][-1]['content'])]
+        if not ids:
+            singles.append(payload)
+            return "Action: [Stay]\nThought: [asked again]"
+        return "\n\n".join("### Agent {}\nAction: [{}]\nThought: [batch]".format(
+            i, "Attack: Agent5" if i == bad_id else "Stay") for i in ids)
+
+    async def go():
+        sim.client.chat = chat
+        await sim.step()
+        await sim.close()
+
+    asyncio.run(go())
+    assert len(singles) == 1
+    assert sim.batch_stats['fallbacks'] == 1
+    assert sim.batch_stats['batched_agents'] == 5
+    for agent in sim.agents:
+        assert agent.action == "Stay"
+        assert agent.age == 1
+    assert sim.registry.get(bad_id).thoughts == "asked again"
+    assert sim.metrics.total_actions == 6
+    with open(tmp_path / "decisions.jsonl", encoding='utf-8') as f:
+        records = [json.loads(line) for line in f]
+    assert sorted(r['agent_id'] for r in records) == sorted(a.id for a in sim.agents)  # 1体1件（失敗した応答は残さない）
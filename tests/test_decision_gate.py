@@ -0,0 +1,44 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+def fake_chat(sim):
+    async def chat(payload):
+        await asyncio.sleep(0)
+        ids = [int(i) for i in main.BATCH_HEADER.findall(payload['messages'][-1]['content'])]
+        answer = "Action: [Stay]\nMessage: [hi]\nThought: [wait]"
+        if not ids:
+            return answer
+        return "\n\n".join("### Agent {}\n{}".format(i, answer) for i in ids)
+    return chat
+
+
+@pytest.mark.parametrize('batch_size', [1, 4])
+def test_gated_agents_act_after_all_views_are_read(batch_size):
+    # 同じ状況が続く世界（全員Stay、エネルギー帯が変わらない）で、使い回しの適用が他の個体の視界読み取りより先に起きないこと
+    sim = main.Simulation(num_agents=8, grid_size=20, api_key='test', seed=3, log_history=1, initial_energy=140,
+                          energy_spawn_rate=0.0, batch_size=batch_size, decision_gate=main.DecisionGate(max_stale=5))
+    sim.client.chat = fake_chat(sim)
+    reads = []
+    get_local_view = main.LLMAgent.get_local_view
+
+    def spy(agent, *args, **kwargs):
+        reads.append((sim.step_count, [a.age for a in sim.agents]))
+        return get_local_view(agent, *args, **kwargs)
+
+    async def go():
+        main.LLMAgent.get_local_view = spy
+        try:
+            for _ in range(4):
+                await sim.step()
+        finally:
+            main.LLMAgent.get_local_view = get_local_view
+            await sim.close()
+
+    asyncio.run(go())
+    assert sim.decision_gate.stats['skipped'] > 0
+    for step, ages in reads:
+        assert ages == [step - 1] * len(ages)  # 読み取り時点ではこのステップに誰も行動していない
@@ -0,0 +1,43 @@
+import asyncio
+
+import main
+
+
+def make_sim(num_agents=4):
+    return main.Simulation(num_agents=num_agents, grid_size=20, api_key="APIキーはここに入れてね", seed=1,
+                           log_history=1, energy_spawn_rate=0.0)
+
+
+def run_ticks(sim, ticks, response):
+    async def decide(agent, system_prompt, user_prompt):
+        return response
+
+    async def go():
+        sim._decide = decide
+        scheduler = main.EventScheduler(sim, tick_seconds=0.02)
+        await scheduler.run(ticks)
+        await sim.close()
+        return scheduler
+
+    return asyncio.run(go())
+
+
+def test_unparsable_action_keeps_agents_scheduled():
+    # 'Attack: Agent1' は _apply_response の int() で失敗する: Stayとして精算し、次の起床も予約されること
+    sim = make_sim()
+    scheduler = run_ticks(sim, 6, "Action: [Attack: Agent1]\nThought: [bad target]")
+    agents = list(sim.registry.active.values())
+    assert scheduler.stats['failed_actions'] == scheduler.stats['decisions']
+    assert scheduler.stats['decisions'] >= len(agents) * 5
+    for agent in agents:
+        assert agent.action == "Stay"
+        assert agent.energy <= main.INITIAL_ENERGY - 5  # Stay = 1/判断 を毎ティック払っている
+
+
+def test_each_agent_decides_once_per_tick():
+    sim = make_sim()
+    scheduler = run_ticks(sim, 5, "Action: [Stay]\nThought: [wait]")
+    assert scheduler.stats['failed_actions'] == 0
+    assert scheduler.stats['decisions'] == 4 * 5
+    assert sim.step_count == 5
+    assert all(agent.age == 5 for agent in sim.agents)
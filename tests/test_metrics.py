@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+def recount(sim):
+    # 総当たり: 生存者を毎回数え直す（MetricsAccumulator の差分更新と突き合わせる）
+    living = sim.registry.living()
+    ages = [agent.age for agent in living]
+    return {
+        'alive': len(living),
+        'total_energy': sum(agent.energy for agent in living),
+        'avg_age': sum(ages) / len(ages) if ages else 0,
+        'max_age': max(ages, default=0),
+        'mbti_counts': {t: sum(agent.mbti_type == t for agent in living) for t in main.MBTI_TYPES},
+    }
+
+
+@pytest.mark.parametrize("use_agent_store", [True, False])
+def test_metrics_match_brute_force_recount(use_agent_store):
+    sim = main.Simulation(num_agents=12, grid_size=20, api_key="APIキーはここに入れてね", seed=5,
+                          log_history=1, use_agent_store=use_agent_store,
+                          policy=main.HeuristicPolicy(seed=5, attack_prob=0.2))
+    births = deaths = 0
+    action_totals = dict.fromkeys(main.ACTION_KINDS, 0)
+
+    async def go():
+        nonlocal births, deaths
+        for _ in range(40):
+            living_before = len(sim.registry.living())
+            born_before = sim.registry.next_id
+            await sim.step()
+            snapshot = sim.metrics.snapshot()
+            expected = recount(sim)
+            assert snapshot['avg_age'] == pytest.approx(expected.pop('avg_age'))
+            assert {k: snapshot[k] for k in expected} == expected
+            if sim.agent_store is not None:
+                stats = sim.agent_store.population_stats()
+                assert stats['avg_age'] == pytest.approx(snapshot['avg_age'])
+                assert {k: stats[k] for k in expected} == expected
+            # 行動数: ステップ分は行動した個体数を超えず、累計はステップ分の和
+            assert sum(snapshot['step_actions'].values()) <= living_before
+            for kind, n in snapshot['step_actions'].items():
+                action_totals[kind] += n
+            assert snapshot['action_counts'] == action_totals
+            assert snapshot['total_actions'] == sum(action_totals.values())
+            births += sim.registry.next_id - born_before
+            deaths += living_before + sim.registry.next_id - born_before - snapshot['alive']
+            if not snapshot['alive']:
+                break
+            if sim.step_count == 20:
+                # 初期個体（最年長）をまとめて死なせる: 最大年齢が子世代の年齢まで繰り下がる経路
+                for agent in sim.registry.living():
+                    if agent.parent is None:
+                        sim._mark_dead(agent, 'test')
+                assert sim.metrics.max_age < 20
+        await sim.close()
+
+    asyncio.run(go())
+    assert births and deaths  # 誕生と死亡の両方を通っていること
+
+
+@pytest.mark.parametrize("tick_model", ['action', 'time'])
+def test_total_energy_matches_recount_after_upkeep(tick_model):
+    # イベント駆動スケジューラは1体ずつ _charge で精算する: ティックごとに総エネルギーを数え直して突き合わせる
+    sim = main.Simulation(num_agents=6, grid_size=20, api_key="APIキーはここに入れてね", seed=2,
+                          log_history=1, initial_energy=12, energy_spawn_rate=0.0)
+    responses = ["Action: [Move to (1,0)]\nThought: [walk]", "Action: [Stay]\nThought: [wait]"]
+    decisions = []
+
+    async def decide(agent, system_prompt, user_prompt):
+        decisions.append(agent.id)
+        return responses[len(decisions) % 2]
+
+    async def on_tick(tick):
+        assert sim.metrics.total_energy == recount(sim)['total_energy']
+
+    async def go():
+        sim._decide = decide
+        scheduler = main.EventScheduler(sim, tick_seconds=0.02, tick_model=tick_model, metabolism=2)
+        await scheduler.run(10, on_tick=on_tick)
+        await sim.close()
+
+    asyncio.run(go())
+    assert sim.stats['total_died'] > 0  # 餓死（0以下で死亡）まで精算が進んでいること
+    assert sim.metrics.total_energy == recount(sim)['total_energy']
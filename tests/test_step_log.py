@@ -0,0 +1,35 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+def write_log(path, keyframe_every, compression=None, steps=30):
+    # 同じシードのヒューリスティック実行: 誕生/死亡/エネルギー出現/メッセージが差分に混ざる
+    writer = main.StepLogWriter(str(path), compression=compression, keyframe_every=keyframe_every)
+    sim = main.Simulation(num_agents=12, grid_size=20, api_key="APIキーはここに入れてね", seed=3,
+                          log_writer=writer, log_history=1, policy=main.HeuristicPolicy(seed=3))
+
+    async def go():
+        for _ in range(steps):
+            await sim.step()
+        await sim.close()
+
+    asyncio.run(go())
+
+
+@pytest.mark.parametrize("keyframe_every,compression", [(1, None), (4, None), (7, 'gzip')])
+def test_delta_log_decodes_to_full_snapshots(tmp_path, keyframe_every, compression):
+    full_path = tmp_path / "full.jsonl"
+    delta_path = tmp_path / ("delta.jsonl" + main.LOG_SUFFIXES[compression])
+    write_log(full_path, keyframe_every=0)
+    write_log(delta_path, keyframe_every=keyframe_every, compression=compression)
+
+    full = list(main.read_step_log(str(full_path)))
+    decoded = list(main.read_step_log(str(delta_path)))
+    assert len(full) == 30
+    assert decoded == full
+    assert len({len(record['agents']) for record in full}) > 1  # 個体数が変わる区間を含むこと
+    for step in (full[0]['step'], full[keyframe_every]['step'], full[-1]['step']):
+        assert main.read_step(str(delta_path), step) == full[step - full[0]['step']]
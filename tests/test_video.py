@@ -0,0 +1,23 @@
+import json
+
+import numpy as np
+import pytest
+
+import main
+
+
+@pytest.mark.skipif(main.Image is None, reason="Pillow is not installed")
+def test_pillow_fallback_stops_at_frame_cap(tmp_path):
+    # Pillowの書き出しは全フレームを持つので、上限を超えた分は書かずに数だけ残す
+    video = main.FrameVideoWriter(str(tmp_path / "run"), fmt='gif', fps=2, max_fallback_frames=3)
+    for step in range(5):
+        video.write(step, np.full((8, 8, 4), step * 40, dtype=np.uint8))
+    video.close()
+
+    assert video.dropped == 2
+    with main.Image.open(video.path) as gif:
+        assert gif.n_frames == 3
+    with open(video.index_path, encoding='utf-8') as f:
+        index = json.load(f)
+    assert [frame['step'] for frame in index['frames']] == [0, 1, 2]
+    assert index['dropped_frames'] == 2